@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+Attribute Canvas server-side time (from a Rails development.log) to controller actions and data loading phases.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import re
+import sys
+
+DEFAULT_TOP_SQL: int = 10
+MAX_SQL_LENGTH: int = 200
+
+# Loading phases (see scripts/load-data.py), identified by request method and path.
+# The first matching pattern wins.
+PHASE_PATTERNS: list = [
+    ('tokens', re.compile(r'^(GET|POST) /login/canvas')),
+    ('tokens', re.compile(r'^POST /api/v1/users/self/tokens')),
+    ('users', re.compile(r'^POST /api/v1/accounts/\d+/(sub_accounts|users)$')),
+    ('courses', re.compile(r'^POST /api/v1/accounts/\d+/courses$')),
+    ('enrollments', re.compile(r'^POST /api/v1/courses/\d+/enrollments$')),
+    ('submissions', re.compile(r'^PUT /api/v1/courses/\d+/assignments/\d+/submissions/\d+$')),
+    ('assignments', re.compile(r'^POST /api/v1/courses/\d+/assignments$')),
+    ('groups', re.compile(r'^(GET|POST) /api/v1/(courses/\d+/group_categories|group_categories/|groups/|progress/)')),
+    ('quizzes', re.compile(r'^\S+ /api/v1/courses/\d+/quizzes')),
+    # The quiz uploader also looks up assignment groups and uploads (quiz images) into hidden folders.
+    ('quizzes', re.compile(r'^\S+ /api/v1/courses/\d+/(assignment_groups|files|folders)')),
+    ('quizzes', re.compile(r'^\S+ /api/v1/folders/\d+')),
+    ('quizzes', re.compile(r'^\S+ /(files_api|api/v1/files/\d+/create_success)')),
+]
+PHASE_OTHER: str = 'other'
+
+ANSI_ESCAPE_PATTERN: re.Pattern = re.compile(r'\x1b\[[0-9;]*m')
+TAGS_PATTERN: re.Pattern = re.compile(r'^((?:\[[^\]]*\] )+)')
+STARTED_PATTERN: re.Pattern = re.compile(r'^Started (\S+) "([^"]*)" for \S+ at (.+)$')
+PROCESSING_PATTERN: re.Pattern = re.compile(r'^Processing by (\S+) as ')
+COMPLETED_PATTERN: re.Pattern = re.compile(r'^Completed (\d+) .*? in (\d+(?:\.\d+)?)ms(?: \((.*)\))?')
+COMPLETED_PART_PATTERN: re.Pattern = re.compile(r'(Views|ActiveRecord): (\d+(?:\.\d+)?)ms')
+SQL_PATTERN: re.Pattern = re.compile(r'^\s*(?:\S.*?)? \((\d+(?:\.\d+)?)ms\)\s+((?:SELECT|INSERT|UPDATE|DELETE|WITH|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b.*)$')
+SQL_LITERAL_PATTERN: re.Pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\$\d+")
+STARTED_TIME_FORMAT: str = '%Y-%m-%d %H:%M:%S %z'
+
+# Request start times are only logged to the second.
+STARTED_TIME_RESOLUTION: datetime.timedelta = datetime.timedelta(seconds = 1)
+
+# Parse Rails log lines into a list of completed requests.
+# Each request is a dict with: method, path, action, phase, status, start, total_ms, views_ms, active_record_ms, and sql
+# (a list of (duration_ms, statement) pairs).
+# When the log is tagged (e.g., with request ids), lines are attributed to requests by their first tag,
+# otherwise requests are assumed to be sequential.
+def parse_log(lines):
+    requests = []
+    open_requests = {}
+
+    for line in lines:
+        line = ANSI_ESCAPE_PATTERN.sub('', line.rstrip('\n'))
+
+        key = None
+        match = TAGS_PATTERN.match(line)
+        if (match is not None):
+            key = match.group(1).split('] ')[0]
+            line = line[len(match.group(1)):]
+
+        match = STARTED_PATTERN.match(line)
+        if (match is not None):
+            open_requests[key] = {
+                'method': match.group(1),
+                'path': match.group(2).split('?')[0],
+                'action': None,
+                'phase': None,
+                'status': None,
+                'start': _parse_time(match.group(3)),
+                'total_ms': None,
+                'views_ms': 0.0,
+                'active_record_ms': 0.0,
+                'sql': [],
+            }
+            continue
+
+        request = open_requests.get(key, None)
+        if (request is None):
+            continue
+
+        match = PROCESSING_PATTERN.match(line)
+        if (match is not None):
+            request['action'] = match.group(1)
+            continue
+
+        match = COMPLETED_PATTERN.match(line)
+        if (match is not None):
+            request['status'] = int(match.group(1))
+            request['total_ms'] = float(match.group(2))
+
+            for (name, value) in COMPLETED_PART_PATTERN.findall(match.group(3) or ''):
+                if (name == 'Views'):
+                    request['views_ms'] = float(value)
+                else:
+                    request['active_record_ms'] = float(value)
+
+            request['phase'] = get_phase(request['method'], request['path'])
+            if (request['action'] is None):
+                request['action'] = f"{request['method']} {request['path']}"
+
+            requests.append(request)
+            del open_requests[key]
+            continue
+
+        match = SQL_PATTERN.match(line)
+        if (match is not None):
+            request['sql'].append((float(match.group(1)), match.group(2).strip()))
+
+    return requests
+
+# Get the loading phase for a request.
+def get_phase(method, path):
+    request_line = f"{method} {path}"
+    for (phase, pattern) in PHASE_PATTERNS:
+        if (pattern.search(request_line) is not None):
+            return phase
+
+    return PHASE_OTHER
+
+# Replace the literals in a SQL statement so that similar statements can be grouped together.
+def normalize_sql(statement):
+    return re.sub(r'\s+', ' ', SQL_LITERAL_PATTERN.sub('?', statement)).strip()
+
+# Get a percentile (using the nearest-rank method).
+def percentile(values, percent):
+    if (len(values) == 0):
+        return 0.0
+
+    values = sorted(values)
+    rank = max(1, math.ceil((percent / 100.0) * len(values)))
+    return values[rank - 1]
+
+# Build a (JSON-friendly) report from parsed requests.
+def summarize(requests, top_sql = DEFAULT_TOP_SQL):
+    total_ms = sum([request['total_ms'] for request in requests])
+    active_record_ms = sum([request['active_record_ms'] for request in requests])
+
+    wall_ms = None
+    overlapping = False
+    timed_requests = sorted([request for request in requests if (request['start'] is not None)], key = lambda request: request['start'])
+    if (len(timed_requests) > 0):
+        first = timed_requests[0]['start']
+        last = None
+
+        for request in timed_requests:
+            # Only count requests that must have overlapped, given the resolution of the start times.
+            if ((last is not None) and ((request['start'] + STARTED_TIME_RESOLUTION) < last)):
+                overlapping = True
+
+            end = request['start'] + datetime.timedelta(milliseconds = request['total_ms'])
+            if ((last is None) or (end > last)):
+                last = end
+
+        wall_ms = (last - first).total_seconds() * 1000.0
+
+    # Wall time that is not inside any Canvas request (e.g., the loader's own work, direct SQL, and sleeps).
+    # When requests overlap (e.g., with --max-concurrency), server time cannot be subtracted from wall time.
+    unattributed_ms = None
+    if ((wall_ms is not None) and (not overlapping)):
+        unattributed_ms = max(0.0, wall_ms - total_ms)
+
+    statements = []
+    statement_groups = {}
+    for request in requests:
+        for (duration_ms, statement) in request['sql']:
+            statements.append((duration_ms, statement, request['action']))
+
+            group = statement_groups.setdefault(normalize_sql(statement), [])
+            group.append(duration_ms)
+
+    statements.sort(key = lambda item: item[0], reverse = True)
+
+    grouped_statements = [
+        {
+            'statement': _truncate(statement),
+            'count': len(durations),
+            'total_ms': sum(durations),
+            'max_ms': max(durations),
+        }
+        for (statement, durations) in statement_groups.items()
+    ]
+    grouped_statements.sort(key = lambda item: item['total_ms'], reverse = True)
+
+    return {
+        'totals': {
+            'requests': len(requests),
+            'wall_ms': wall_ms,
+            'server_ms': total_ms,
+            'active_record_ms': active_record_ms,
+            'server_non_db_ms': total_ms - active_record_ms,
+            'overlapping_requests': overlapping,
+            'unattributed_ms': unattributed_ms,
+        },
+        'phases': _summarize_groups(requests, 'phase'),
+        'actions': _summarize_groups(requests, 'action'),
+        'slowest_sql': [
+            {
+                'duration_ms': duration_ms,
+                'action': action,
+                'statement': _truncate(statement),
+            }
+            for (duration_ms, statement, action) in statements[:top_sql]
+        ],
+        'costliest_sql': grouped_statements[:top_sql],
+    }
+
+def _summarize_groups(requests, field):
+    groups = {}
+    for request in requests:
+        groups.setdefault(request[field], []).append(request)
+
+    results = []
+    for (name, group) in groups.items():
+        stats = {
+            'name': name,
+            'count': len(group),
+        }
+
+        for metric in ['total_ms', 'active_record_ms', 'views_ms']:
+            values = [request[metric] for request in group]
+            prefix = metric[:-len('_ms')]
+
+            stats[f"{prefix}_sum_ms"] = sum(values)
+            stats[f"{prefix}_p50_ms"] = percentile(values, 50)
+            stats[f"{prefix}_p95_ms"] = percentile(values, 95)
+
+        results.append(stats)
+
+    results.sort(key = lambda item: item['total_sum_ms'], reverse = True)
+    return results
+
+# Format a report as human-readable text.
+def format_report(report):
+    totals = report['totals']
+
+    lines = [
+        f"Requests: {totals['requests']}",
+        f"Server Time: {_format_ms(totals['server_ms'])}"
+            + f" (ActiveRecord: {_format_ms(totals['active_record_ms'])}, Other: {_format_ms(totals['server_non_db_ms'])})",
+    ]
+
+    if (totals['wall_ms'] is not None):
+        if (totals['overlapping_requests']):
+            note = 'requests overlap, so server time is not subtracted'
+        else:
+            note = f"not attributed to Canvas requests: {_format_ms(totals['unattributed_ms'])}"
+
+        lines.append(f"Wall Time: {_format_ms(totals['wall_ms'])} ({note})")
+
+    for (title, key) in [('Phase', 'phases'), ('Controller Action', 'actions')]:
+        lines.append('')
+        lines += _format_table(title, report[key])
+
+    lines.append('')
+    lines.append('Slowest SQL Statements:')
+    for item in report['slowest_sql']:
+        lines.append(f"    {item['duration_ms']:10.1f}ms  {item['action']}  {item['statement']}")
+
+    lines.append('')
+    lines.append('Costliest SQL Statements (Grouped):')
+    for item in report['costliest_sql']:
+        lines.append(f"    {item['total_ms']:10.1f}ms  x{item['count']:<6d} (max {item['max_ms']:.1f}ms)  {item['statement']}")
+
+    return "\n".join(lines)
+
+def _format_table(title, rows):
+    header = [title, 'Count', 'Total', 'p50', 'p95', 'AR Total', 'AR p50', 'AR p95', 'Views Total']
+
+    table = [header]
+    for row in rows:
+        table.append([
+            str(row['name']),
+            str(row['count']),
+            _format_ms(row['total_sum_ms']),
+            _format_ms(row['total_p50_ms']),
+            _format_ms(row['total_p95_ms']),
+            _format_ms(row['active_record_sum_ms']),
+            _format_ms(row['active_record_p50_ms']),
+            _format_ms(row['active_record_p95_ms']),
+            _format_ms(row['views_sum_ms']),
+        ])
+
+    widths = [max([len(row[i]) for row in table]) for i in range(len(header))]
+
+    lines = []
+    for row in table:
+        cells = [row[0].ljust(widths[0])] + [row[i].rjust(widths[i]) for i in range(1, len(row))]
+        lines.append('  '.join(cells).rstrip())
+
+    return lines
+
+def _format_ms(value):
+    if (value is None):
+        return '-'
+
+    if (value >= 1000.0):
+        return f"{value / 1000.0:.2f}s"
+
+    return f"{value:.1f}ms"
+
+def _truncate(statement):
+    statement = re.sub(r'\s+', ' ', statement)
+    if (len(statement) <= MAX_SQL_LENGTH):
+        return statement
+
+    return statement[:(MAX_SQL_LENGTH - 3)] + '...'
+
+def _parse_time(text):
+    try:
+        return datetime.datetime.strptime(text.strip(), STARTED_TIME_FORMAT)
+    except ValueError:
+        return None
+
+def run_cli(args):
+    with open(args.path, 'r', encoding = 'utf-8', errors = 'replace') as file:
+        requests = parse_log(file)
+
+    report = summarize(requests, top_sql = args.top_sql)
+
+    if (args.json):
+        print(json.dumps(report, indent = 4))
+    else:
+        print(format_report(report))
+
+    phases = {phase['name'] for phase in report['phases']}
+    missing_phases = [phase for phase in (args.require_phases or []) if (phase not in phases)]
+    if (len(missing_phases) > 0):
+        print(f"ERROR: No requests were found for phase(s): {', '.join(missing_phases)}.", file = sys.stderr)
+        return 1
+
+    return 0
+
+def main():
+    return run_cli(_get_parser().parse_args())
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+
+    parser.add_argument('path', metavar = 'LOG',
+        action = 'store', type = str,
+        help = 'The Canvas (Rails) log to analyze, e.g., log/development.log.')
+
+    parser.add_argument('--top-sql', dest = 'top_sql',
+        action = 'store', type = int, default = DEFAULT_TOP_SQL,
+        help = 'The number of expensive SQL statements to report (default: %(default)s).')
+
+    parser.add_argument('--require-phase', dest = 'require_phases',
+        action = 'append', type = str, default = None,
+        choices = sorted({phase for (phase, _) in PHASE_PATTERNS} | {PHASE_OTHER}),
+        help = 'Fail if the log has no requests for this phase (e.g., to check the parser against a real log). May be repeated.')
+
+    parser.add_argument('--json', dest = 'json',
+        action = 'store_true', default = False,
+        help = 'If true, output the report as JSON (default: %(default)s).')
+
+    return parser
+
+if (__name__ == '__main__'):
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+Check that load plan op keys (see load-data.py) are stable:
+adding a submission to a dataset should only add that submission's ops (and re-key the per-chunk ops around it).
+No Canvas server is needed.
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+
+import edq.util.pyimport
+
+THIS_DIR: str = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+LOAD_DATA_SCRIPT: str = os.path.join(THIS_DIR, 'load-data.py')
+
+BASE_SUBMISSION_IDS: list = [110, 120, 130, 140, 150]
+CHUNK_SIZE: int = 2
+
+# Fields that depend on how submissions are chunked, rather than on the op itself.
+CHUNK_FIELDS: list = ['parallel_group', 'parallel_unit']
+CHUNK_KEY_PREFIX: str = 'submissions:'
+
+# {name: submission ids}
+VARIANTS: dict = {
+    'appended': BASE_SUBMISSION_IDS + [160],
+    'inserted first': [100] + BASE_SUBMISSION_IDS,
+    'inserted middle': BASE_SUBMISSION_IDS[:2] + [125] + BASE_SUBMISSION_IDS[2:],
+}
+
+def make_dataset(submission_ids):
+    user_names = ['server-owner', 'course-owner', 'course-student']
+
+    users = {}
+    for (index, name) in enumerate(user_names):
+        users[name] = {
+            'id': 100000 + index,
+            'name': name,
+            'email': f"{name}@test.edulinq.org",
+            'password': name,
+            'course-info': {},
+        }
+
+    users['course-owner']['course-info']['course101'] = {'role': 'owner'}
+    users['course-student']['course-info']['course101'] = {'role': 'student'}
+
+    courses = {
+        'course101': {
+            'id': 1000,
+            'name': 'Course 101',
+            'short-name': 'course101',
+        },
+    }
+
+    assignments = {
+        'hw0': {
+            'id': 2000,
+            'course': 'course101',
+            'type': 'empty',
+            'name': 'Homework 0',
+            'max-points': 2.0,
+        },
+    }
+
+    submissions = {}
+    for submission_id in submission_ids:
+        submissions[str(submission_id)] = {
+            'id': submission_id,
+            'course': 'course101',
+            'assignment': 'hw0',
+            'user': 'course-student',
+            'score': 1.0,
+        }
+
+    return (users, courses, assignments, {}, submissions)
+
+# Record a plan and return its (serialized) ops by key.
+def record_plan(load_data, submission_ids):
+    (users, courses, assignments, groupsets, submissions) = copy.deepcopy(make_dataset(submission_ids))
+
+    recorder = load_data.PlanRecorder()
+    load_data.set_plan_recorder(recorder)
+
+    try:
+        load_data.load_data(users, courses, assignments, groupsets.values(), submissions.values(), chunk_size = CHUNK_SIZE)
+    finally:
+        load_data.set_plan_recorder(None)
+
+    # Compare ops as they would be written (e.g., with references as strings).
+    ops = json.loads(json.dumps(recorder.ops, default = str))
+    return {op['key']: op for op in ops}
+
+# Get a list of problems with a plan's keys.
+# Each submission's own ops should be keyed by just the submission (not by its chunk).
+def check_plan(ops, submission_ids):
+    errors = []
+
+    for submission_id in submission_ids:
+        prefix = f"submission:{submission_id}/"
+        if (not any([key.startswith(prefix) for key in ops])):
+            errors.append(f"No ops are keyed by submission {submission_id} (expected keys starting with '{prefix}').")
+
+    return errors
+
+# Get a list of problems with a variant's plan (compared to the base plan).
+def check_variant(base_ops, variant_ops, new_submission_ids):
+    errors = []
+
+    new_prefixes = [f"submission:{submission_id}/" for submission_id in new_submission_ids]
+
+    for (key, op) in base_ops.items():
+        if (key.startswith(CHUNK_KEY_PREFIX)):
+            continue
+
+        if (key not in variant_ops):
+            errors.append(f"Op '{key}' is missing.")
+            continue
+
+        if (_strip_chunk_fields(op) != _strip_chunk_fields(variant_ops[key])):
+            errors.append(f"Op '{key}' changed.")
+
+    for key in variant_ops:
+        if ((key in base_ops) or key.startswith(CHUNK_KEY_PREFIX)):
+            continue
+
+        if (not any([key.startswith(prefix) for prefix in new_prefixes])):
+            errors.append(f"Op '{key}' was added, but does not belong to a new submission.")
+
+    return errors
+
+def _strip_chunk_fields(op):
+    return {key: value for (key, value) in op.items() if (key not in CHUNK_FIELDS)}
+
+def run_cli(args):
+    load_data = edq.util.pyimport.import_path(LOAD_DATA_SCRIPT)
+
+    base_ops = record_plan(load_data, BASE_SUBMISSION_IDS)
+
+    errors = check_plan(base_ops, BASE_SUBMISSION_IDS)
+    if (len(errors) > 0):
+        print("Plan keys are not keyed by submission:")
+        for error in errors:
+            print(f"    {error}")
+
+        return 1
+
+    failed = False
+    for (name, submission_ids) in VARIANTS.items():
+        new_submission_ids = sorted(set(submission_ids) - set(BASE_SUBMISSION_IDS))
+
+        variant_ops = record_plan(load_data, submission_ids)
+        errors = check_plan(variant_ops, submission_ids) + check_variant(base_ops, variant_ops, new_submission_ids)
+
+        if (len(errors) == 0):
+            print(f"Plan keys are stable with a submission {name}.")
+            continue
+
+        failed = True
+        print(f"Plan keys are not stable with a submission {name}:")
+        for error in errors:
+            print(f"    {error}")
+
+    if (failed):
+        return 1
+
+    return 0
+
+def main():
+    return run_cli(_get_parser().parse_args())
+
+def _get_parser():
+    return argparse.ArgumentParser(description = __doc__.strip())
+
+if (__name__ == '__main__'):
+    sys.exit(main())
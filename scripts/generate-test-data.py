@@ -12,17 +12,28 @@ import lms.testing.testdata
 
 THIS_DIR: str = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
 TEST_DATA_DIR: str = os.path.join(THIS_DIR, '..', 'testdata', 'http')
+SERVER_POOL_SCRIPT: str = os.path.join(THIS_DIR, 'server-pool.py')
 
 DEFAULT_CONTAINER_NAME: str = 'canvas-generate-test-data'
 DEFAULT_IMAGE_NAME: str = 'ghcr.io/edulinq/lms-docker-canvas-testdata'
 DEFAULT_PORT: int = 3000
 
+# Shared by generate-test-data.py and verify-test-data.py, so either can reuse a server the other left warm.
+DEFAULT_POOL_NAME: str = 'canvas-pool'
+
 def run_cli(args):
+    server_start_command = f"docker run --rm -p {args.port}:3000 --name '{args.container_name}' '{args.image_name}'"
+    server_stop_command = f"docker kill '{args.container_name}'"
+
+    if (args.pool):
+        server_start_command = f"'{SERVER_POOL_SCRIPT}' acquire --name '{args.pool_name}' --image-name '{args.image_name}' --port {args.port}"
+        server_stop_command = f"'{SERVER_POOL_SCRIPT}' release --name '{args.pool_name}'"
+
     args = {
         'server': f"127.0.0.1:{args.port}",
         'backend_type': 'canvas',
-        'server_start_command': f"docker run --rm -p {args.port}:3000 --name '{args.container_name}' '{args.image_name}'",
-        'server_stop_command': f"docker kill '{args.container_name}'",
+        'server_start_command': server_start_command,
+        'server_stop_command': server_stop_command,
         'http_exchanges_out_dir': args.out_dir,
         'fail_fast': args.fail_fast,
         'pattern': args.pattern,
@@ -52,6 +63,14 @@ def _get_parser():
         action = 'store', type = str, default = TEST_DATA_DIR,
         help = 'Where the output HTTP exchanges will be written (default: %(default)s).')
 
+    parser.add_argument('--pool', dest = 'pool',
+        action = 'store_true', default = False,
+        help = 'If true, use (and leave running) a warm server from the server pool (see server-pool.py) instead of starting a new one (default: %(default)s).')
+
+    parser.add_argument('--pool-name', dest = 'pool_name',
+        action = 'store', type = str, default = DEFAULT_POOL_NAME,
+        help = 'The name of the pooled server (and its container) to use with --pool (default: %(default)s).')
+
     parser.add_argument('--fail-fast', dest = 'fail_fast',
         action = 'store_true', default = False,
         help = 'If true, stop on the first test failure (default: %(default)s).')
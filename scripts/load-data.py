@@ -1,15 +1,35 @@
 #!/usr/bin/env python3
 
+"""
+Load the LMS test data into a running Canvas instance.
+"""
+
+import argparse
+import atexit
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import hashlib
 import http
+import io
+import json
 import os
+import pickle
+import random
 import urllib.parse
 import re
-import subprocess
+import resource
+import struct
 import sys
+import tempfile
+import threading
 import time
 
 import edq.util.pyimport
+import psycopg2
+import psycopg2.extras
+import psycopg2.sql
 import requests
 import quizcomp.quiz
 import quizcomp.uploader.canvas
@@ -26,12 +46,78 @@ API_BASE = 'api/v1'
 # We need to sleep to ensure consistent IDs.
 API_WRITE_WAIT_SECS = 0.10
 
+DB_NAME = 'canvas_development'
+
+# The number of statements sent to the database in a single round trip when batching.
+SQL_BATCH_SIZE = 100
+
 SERVER_OWNER_ACCOUNT_ID = 1
 SERVER_OWNER_USER_ID = 1
 
 START_WAIT_ATTEMPTS = 5
 START_WAIT_TIME_SECS = 5.0
 
+# Requests that fail transiently are retried (with jittered exponential backoff) up to this many attempts.
+REQUEST_MAX_ATTEMPTS = 5
+REQUEST_BACKOFF_BASE_SECS = 0.5
+REQUEST_BACKOFF_MAX_SECS = 30.0
+REQUEST_RETRY_STATUSES = {
+    http.HTTPStatus.INTERNAL_SERVER_ERROR,
+    http.HTTPStatus.BAD_GATEWAY,
+    http.HTTPStatus.SERVICE_UNAVAILABLE,
+    http.HTTPStatus.GATEWAY_TIMEOUT,
+}
+
+# Transient failures that leave no (complete) response, e.g., a refused connection or a connection reset mid-body.
+REQUEST_RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+# When the rate-limit budget reported by Canvas (X-Rate-Limit-Remaining) drops below this,
+# or the (smoothed) latency grows past this factor of the best seen latency, concurrency is reduced.
+# Latency is tracked per endpoint (with IDs removed), since different endpoints have very different costs.
+RATE_LIMIT_LOW_WATERMARK = 100.0
+REQUEST_LATENCY_BACKOFF_FACTOR = 3.0
+REQUEST_LATENCY_SMOOTHING = 0.2
+REQUEST_ENDPOINT_ID_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+# Load plans record the HTTP requests and SQL statements that loading would make, see PlanRecorder.
+# Bump the version whenever the plan format changes.
+# Ops are identified by keys built from what they do (e.g., 'user:course-owner/post-users'), see PlanRecorder.
+PLAN_VERSION = 2
+PLAN_KEY_INVALID_PATTERN = re.compile(r'[^A-Za-z0-9_:/#-]')
+PLAN_REF_PATTERN = re.compile(r'\$\{([A-Za-z0-9_:/#-]+)((?:\.[^.{}]+)*)\}')
+PLAN_HTTP_METHODS = {
+    'GET': requests.get,
+    'POST': requests.post,
+    'PUT': requests.put,
+}
+
+# Group imports are run as background jobs, so we need to poll for their completion.
+GROUP_IMPORT_WAIT_ATTEMPTS = 120
+GROUP_IMPORT_WAIT_TIME_SECS = 0.5
+
+# See: https://developerdocs.instructure.com/services/canvas/resources/progress
+PROGRESS_STATE_COMPLETED = 'completed'
+PROGRESS_STATE_FAILED = 'failed'
+
+# Parsed datasets are cached (keyed by a fingerprint of the source files) so repeated loads skip parsing.
+# The cache lives in a per-user cache directory (the cache contains pickled data, so it must only be writable by its owner).
+# Bump the version whenever the cached format changes.
+DATASET_CACHE_VERSION = 3
+DEFAULT_DATASET_CACHE_PATH = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'lms-docker-canvas-testdata', 'dataset.cache')
+DATASET_CACHE_KEY_MTIME = 'mtime'
+DATASET_CACHE_KEY_HASH = 'hash'
+DATASET_CACHE_KEY_TYPES = [DATASET_CACHE_KEY_MTIME, DATASET_CACHE_KEY_HASH]
+DATASET_CACHE_TRAILER = struct.Struct('<Q')
+
+# When streaming, submissions are read and loaded in chunks of this size.
+DEFAULT_STREAM_CHUNK_SIZE = 500
+
 # The randomly generated user tokens will be replaced in the database with these static tokens.
 # This makes it much easier for those using the image to consistently access the API.
 # Format: {user_name: (crypted_token, token_hint, crypted_refresh_token), ...}
@@ -116,16 +202,794 @@ def timestamp_to_canvas(timestamp, timezone = datetime.timezone.utc):
     pytime = datetime.datetime.fromtimestamp(timestamp / 1000, timezone)
     return pytime.isoformat(timespec = 'milliseconds')
 
-def run_sql(sql, db = 'canvas_development', clean_space = True, check = True, get_records = False):
-    if (clean_space):
-        sql = re.sub(r'\s+', ' ', sql)
+# Named, parameterized statements used when loading data.
+# Each statement is prepared (on first use) once per session and then executed with bound values.
+SQL_STATEMENTS = {
+    'update_user_id': """
+        WITH
+        access_tokens_fk_update_fk_update as (
+            UPDATE public.access_tokens
+            SET user_id = $1
+            WHERE user_id = $2
+        ),
+        account_users_fk_update as (
+            UPDATE public.account_users
+            SET user_id = $1
+            WHERE user_id = $2
+        ),
+        communication_channels_fk_update as (
+            UPDATE public.communication_channels
+            SET user_id = $1
+            WHERE user_id = $2
+        ),
+        pseudonyms_channels_fk_update as (
+            UPDATE public.pseudonyms
+            SET user_id = $1
+            WHERE user_id = $2
+        ),
+        user_account_associations_channels_fk_update as (
+            UPDATE public.user_account_associations
+            SET user_id = $1
+            WHERE user_id = $2
+        )
+        UPDATE public.users
+        SET id = $1
+        WHERE id = $2
+    """,
+    'update_course_id': """
+        WITH
+            course_account_associations_fk_update AS (
+                UPDATE public.course_account_associations
+                SET course_id = $1
+                WHERE course_id = $2
+            ),
+            post_policies_fk_update AS (
+                UPDATE public.post_policies
+                SET course_id = $1
+                WHERE course_id = $2
+            )
+        UPDATE public.courses
+        SET id = $1
+        WHERE id = $2
+    """,
+    'update_assignment_id': """
+        WITH
+            post_policies_fk_update AS (
+                UPDATE public.post_policies
+                SET assignment_id = $1
+                WHERE assignment_id = $2
+            ),
+
+            submissions_fk_update AS (
+                UPDATE public.submissions
+                SET assignment_id = $1
+                WHERE assignment_id = $2
+            )
+        UPDATE public.assignments
+        SET id = $1
+        WHERE id = $2
+    """,
+    # Params: (id, submitted_at, graded_at/posted_at, assignment_id, user_id).
+    # Null times leave the existing value in place.
+    'update_submission': """
+        UPDATE public.submissions
+        SET
+            id = $1,
+            submitted_at = COALESCE(TO_TIMESTAMP($2), submitted_at),
+            graded_at = COALESCE(TO_TIMESTAMP($3), graded_at),
+            posted_at = COALESCE(TO_TIMESTAMP($3), posted_at)
+        WHERE
+            assignment_id = $4
+            AND user_id = $5
+    """,
+    'update_groupset_id': """
+        UPDATE public.group_categories
+        SET id = $1
+        WHERE id = $2
+    """,
+    'update_group_id': """
+        UPDATE public.groups
+        SET id = $1
+        WHERE id = $2
+    """,
+    # Params: (groupset_id, group_names, group_ids).
+    # Remap all the (imported) groups in a groupset by name.
+    'update_group_ids_by_name': """
+        WITH
+            group_id_map AS (
+                SELECT
+                    public.groups.id AS old_id,
+                    new_ids.id AS new_id
+                FROM public.groups
+                JOIN unnest($2::text[], $3::bigint[]) AS new_ids(name, id)
+                    ON public.groups.name = new_ids.name
+                WHERE public.groups.group_category_id = $1
+            ),
+            group_memberships_fk_update AS (
+                UPDATE public.group_memberships
+                SET group_id = group_id_map.new_id
+                FROM group_id_map
+                WHERE public.group_memberships.group_id = group_id_map.old_id
+            )
+        UPDATE public.groups
+        SET id = group_id_map.new_id
+        FROM group_id_map
+        WHERE public.groups.id = group_id_map.old_id
+    """,
+    # Params: (groupset_id).
+    # Remove the records left behind by a group category import (its importer, CSV attachment, and progress),
+    # so that later IDs match a build that did not use an import.
+    'delete_group_import_records': """
+        WITH
+            group_and_membership_importers_delete AS (
+                DELETE FROM public.group_and_membership_importers
+                WHERE group_category_id = $1
+                RETURNING attachment_id
+            ),
+            attachments_delete AS (
+                DELETE FROM public.attachments
+                WHERE id IN (SELECT attachment_id FROM group_and_membership_importers_delete)
+            )
+        DELETE FROM public.progresses
+        WHERE
+            context_type = 'GroupCategory'
+            AND context_id = $1
+    """,
+    'reset_group_import_sequences': """
+        SELECT
+            pg_catalog.setval('public.group_and_membership_importers_id_seq',
+                COALESCE((SELECT MAX(id) FROM public.group_and_membership_importers), 0) + 1, false),
+            pg_catalog.setval('public.attachments_id_seq',
+                COALESCE((SELECT MAX(id) FROM public.attachments), 0) + 1, false),
+            pg_catalog.setval('public.progresses_id_seq',
+                COALESCE((SELECT MAX(id) FROM public.progresses), 0) + 1, false)
+    """,
+    # Params: (crypted_token, token_hint, crypted_refresh_token, user_id).
+    'replace_token': """
+        UPDATE public.access_tokens
+        SET
+            crypted_token = $1,
+            token_hint = $2,
+            crypted_refresh_token = $3
+        WHERE
+            user_id = $4
+    """,
+    # Deleted quizzes (e.g., from a retried upload) are skipped.
+    'select_quiz_id': """
+        SELECT id
+        FROM public.quizzes
+        WHERE
+            title = $1
+            AND workflow_state <> 'deleted'
+    """,
+    'update_quiz_id': """
+        WITH
+        quiz_groups_fk_update as (
+            UPDATE public.quiz_groups
+            SET quiz_id = $1
+            WHERE quiz_id = $2
+        ),
+        quiz_questions_fk_update as (
+            UPDATE public.quiz_questions
+            SET quiz_id = $1
+            WHERE quiz_id = $2
+        )
+        UPDATE public.quizzes
+        SET id = $1
+        WHERE id = $2
+    """,
+    'offset_quiz_question_ids': """
+        WITH
+        quiz_groups_id_update as (
+            UPDATE public.quiz_groups
+            SET id = (id + $1)
+            WHERE quiz_id = $1
+        ),
+        quiz_questions_id_update as (
+            UPDATE public.quiz_questions
+            SET
+                id = (id + $1),
+                quiz_group_id = (quiz_group_id + $1),
+                assessment_question_id = (assessment_question_id + $1)
+            WHERE quiz_id = $1
+        ),
+        attachments_contextid_update as (
+            UPDATE public.attachments
+            SET context_id = (context_id + $1)
+            WHERE
+                context_type = 'AssessmentQuestion'
+                AND context_id < 10000
+        )
+        UPDATE public.assessment_questions
+        SET id = (id + $1)
+        WHERE id < 10000
+    """,
+    'reset_assessment_questions_sequence': """
+        SELECT pg_catalog.setval('public.assessment_questions_id_seq', 1, true)
+    """,
+    'select_auditing_tables': """
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE
+            table_schema = 'public'
+            AND table_name LIKE $1
+    """,
+}
+
+# A connection to the Canvas database that prepares named statements (see SQL_STATEMENTS) once
+# and executes them with bound values.
+class SQLSession:
+    def __init__(self, db = DB_NAME, statements = SQL_STATEMENTS):
+        self._statements = statements
+        self._prepared = set()
+
+        self._connection = psycopg2.connect(dbname = db)
+        self._connection.autocommit = True
+
+    def close(self):
+        self._connection.close()
+
+    # Execute a named statement once with the given params.
+    # If get_records is true, all result rows will be returned.
+    def execute(self, name, params = (), get_records = False):
+        with self._connection.cursor() as cursor:
+            cursor.execute(self._prepare(name, len(params), cursor), params)
+
+            if (not get_records):
+                return None
+
+            return cursor.fetchall()
+
+    # Execute a named statement once for each set of params, sending statements to the server in batches.
+    def execute_many(self, name, params_list, page_size = SQL_BATCH_SIZE):
+        params_list = list(params_list)
+        if (len(params_list) == 0):
+            return
+
+        with self._connection.cursor() as cursor:
+            execute_sql = self._prepare(name, len(params_list[0]), cursor)
+            psycopg2.extras.execute_batch(cursor, execute_sql, params_list, page_size = page_size)
+
+    # Execute an ad-hoc (non-prepared) statement.
+    # Only use this for statements that cannot be parameterized (e.g., ones with dynamic identifiers).
+    def execute_adhoc(self, sql, params = None):
+        with self._connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    # Prepare the named statement (if it has not already been) and return the SQL to execute it.
+    def _prepare(self, name, num_params, cursor):
+        if (name not in self._prepared):
+            if (name not in self._statements):
+                raise ValueError(f"Unknown SQL statement: '{name}'.")
+
+            prepare_sql = psycopg2.sql.SQL('PREPARE {} AS {}').format(
+                    psycopg2.sql.Identifier(name), psycopg2.sql.SQL(self._statements[name]))
+            cursor.execute(prepare_sql)
+            self._prepared.add(name)
+
+        if (num_params == 0):
+            return psycopg2.sql.SQL('EXECUTE {}').format(psycopg2.sql.Identifier(name))
+
+        placeholders = psycopg2.sql.SQL(', ').join([psycopg2.sql.Placeholder()] * num_params)
+        return psycopg2.sql.SQL('EXECUTE {} ({})').format(psycopg2.sql.Identifier(name), placeholders)
+
+_sql_session = None
+
+# Get the shared SQL session (creating it on first use).
+def get_sql_session():
+    global _sql_session
+
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        return PlanSQLSession(recorder)
+
+    if (_sql_session is None):
+        _sql_session = SQLSession()
+        atexit.register(_sql_session.close)
+
+    return _sql_session
+
+# Compute a fingerprint for all the files that make up a dataset (including the loading script).
+# With the 'mtime' key type, only each file's path, size, and modification time are considered.
+# With the 'hash' key type, the full content of each file is hashed.
+def dataset_fingerprint(data_dir, load_script = LOAD_SCRIPT, key_type = DATASET_CACHE_KEY_MTIME):
+    if (key_type not in DATASET_CACHE_KEY_TYPES):
+        raise ValueError(f"Unknown dataset cache key type: '{key_type}'.")
+
+    paths = [load_script]
+    for (dirpath, dirnames, filenames) in os.walk(data_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            paths.append(os.path.join(dirpath, filename))
+
+    digest = hashlib.sha256()
+    digest.update(f"{DATASET_CACHE_VERSION}:{key_type}".encode('utf-8'))
+
+    for path in paths:
+        digest.update(os.path.relpath(path, data_dir).encode('utf-8'))
+
+        if (key_type == DATASET_CACHE_KEY_HASH):
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 16), b''):
+                    digest.update(chunk)
+        else:
+            stat = os.stat(path)
+            digest.update(f":{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+
+    return digest.hexdigest()
+
+# Load the dataset: (users, courses, assignments, groupsets, submissions).
+# If a cache path is given, a cached copy of the parsed dataset will be used if the source files have not changed,
+# and the cache will be (re)written if they have.
+#
+# When streaming, only users, courses, and assignments are held in memory.
+# Groupsets and submissions are instead returned as generators that read from the on-disk cache
+# (each groupset's 'groups' is itself a generator, so group memberships are also read lazily).
+# If streaming without a cache path, a temporary cache is used.
+def load_dataset(data_dir = DATA_DIR, load_script = LOAD_SCRIPT, cache_path = None, key_type = DATASET_CACHE_KEY_MTIME,
+        stream = False):
+    if ((cache_path is None) and (not stream)):
+        return _parse_dataset(data_dir, load_script)
+
+    if (cache_path is None):
+        (handle, cache_path) = tempfile.mkstemp(prefix = 'lms-docker-canvas-testdata-dataset-', suffix = '.pickle')
+        os.close(handle)
+        atexit.register(_remove_file, cache_path)
+
+    fingerprint = dataset_fingerprint(data_dir, load_script = load_script, key_type = key_type)
+
+    header = _read_dataset_cache_header(cache_path, fingerprint)
+    if (header is not None):
+        print(f"Loaded cached dataset from '{cache_path}'.")
+    else:
+        dataset = _parse_dataset(data_dir, load_script)
+        header = _write_dataset_cache(cache_path, fingerprint, dataset)
+        print(f"Wrote dataset cache to '{cache_path}'.")
+
+        if (not stream):
+            return dataset
+
+        # Drop the fully parsed dataset, everything else will be streamed from the cache.
+        del dataset
+
+    (users, courses, assignments) = next(_iter_cache_records(cache_path, header['offsets']['resident']))
+
+    submissions = _iter_cached_submissions(cache_path, header['offsets']['submissions'])
+    groupsets = _iter_cached_groupsets(cache_path, header['offsets']['groupsets'])
+
+    if (stream):
+        submissions = (submission for (_, submission) in submissions)
+        groupsets = (groupset for (_, groupset) in groupsets)
+    else:
+        submissions = dict(submissions)
+        groupsets = {key: dict(groupset, groups = list(groupset['groups'])) for (key, groupset) in groupsets}
+
+    return (users, courses, assignments, groupsets, submissions)
+
+# Whether the full dataset was parsed (i.e., held in memory all at once) during this run.
+_dataset_parsed = False
+
+def _parse_dataset(data_dir, load_script):
+    global _dataset_parsed
+    _dataset_parsed = True
+
+    # The Python pathing makes it easier to load this dynamically.
+    return edq.util.pyimport.import_path(load_script).load_test_data(data_dir)
+
+def _remove_file(path):
+    if (os.path.exists(path)):
+        os.remove(path)
+
+# The cache file is laid out as:
+#  - the resident section: a pickled (users, courses, assignments) record, terminated by None,
+#  - the submissions section: one pickled (key, submission) record per submission, terminated by None,
+#  - the groupsets section: a pickled ('groupset', key, groupset) record (without its groups) followed by
+#    one pickled ('group', group) record per group, terminated by None,
+#  - a JSON header with the version, fingerprint, and the offset of each section,
+#  - a fixed-size trailer with the offset of the header.
+# The header is plain JSON so that the cache can be validated before anything is unpickled.
+# Returns the cache header, or None if there is no usable cache.
+def _read_dataset_cache_header(cache_path, fingerprint):
+    if ((not os.path.isfile(cache_path)) or (os.path.getsize(cache_path) < DATASET_CACHE_TRAILER.size)):
+        return None
+
+    # Never trust a cache that someone else could have written.
+    stat = os.stat(cache_path)
+    if ((stat.st_uid != os.getuid()) or ((stat.st_mode & 0o022) != 0)):
+        print(f"Ignoring dataset cache '{cache_path}' that is not exclusively owned by the current user.")
+        return None
+
+    try:
+        with open(cache_path, 'rb') as file:
+            file.seek(-DATASET_CACHE_TRAILER.size, os.SEEK_END)
+            (header_offset, ) = DATASET_CACHE_TRAILER.unpack(file.read(DATASET_CACHE_TRAILER.size))
+
+            file.seek(header_offset)
+            header = json.loads(file.read(stat.st_size - DATASET_CACHE_TRAILER.size - header_offset).decode('utf-8'))
+    except Exception as ex:
+        print(f"Ignoring unreadable dataset cache '{cache_path}'. Error: '{ex}'.")
+        return None
+
+    if ((not isinstance(header, dict)) or (header.get('version', None) != DATASET_CACHE_VERSION)):
+        return None
+
+    if (header.get('fingerprint', None) != fingerprint):
+        return None
+
+    return header
+
+# Write the dataset cache and return its header.
+def _write_dataset_cache(cache_path, fingerprint, dataset):
+    (users, courses, assignments, groupsets, submissions) = dataset
+
+    header = {
+        'version': DATASET_CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'offsets': {},
+    }
+
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(cache_dir, mode = 0o700, exist_ok = True)
+
+    # Write to a temp file and move it into place so that concurrent readers never see a partial cache.
+    (handle, temp_path) = tempfile.mkstemp(dir = cache_dir, prefix = '.dataset-cache-')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            header['offsets']['resident'] = file.tell()
+            pickle.dump((users, courses, assignments), file, protocol = pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, file, protocol = pickle.HIGHEST_PROTOCOL)
+
+            header['offsets']['submissions'] = file.tell()
+            for (key, submission) in submissions.items():
+                pickle.dump((key, submission), file, protocol = pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, file, protocol = pickle.HIGHEST_PROTOCOL)
+
+            header['offsets']['groupsets'] = file.tell()
+            for (key, groupset) in groupsets.items():
+                groupset = {name: value for (name, value) in groupset.items() if (name != 'groups')}
+                pickle.dump(('groupset', key, groupset), file, protocol = pickle.HIGHEST_PROTOCOL)
+
+                for group in groupsets[key].get('groups', []):
+                    pickle.dump(('group', group), file, protocol = pickle.HIGHEST_PROTOCOL)
+            pickle.dump(None, file, protocol = pickle.HIGHEST_PROTOCOL)
+
+            header_offset = file.tell()
+            file.write(json.dumps(header).encode('utf-8'))
+            file.write(DATASET_CACHE_TRAILER.pack(header_offset))
+
+        os.replace(temp_path, cache_path)
+    except Exception:
+        _remove_file(temp_path)
+        raise
+
+    return header
+
+# Yield cached records starting at the given offset until the section terminator.
+def _iter_cache_records(cache_path, offset):
+    with open(cache_path, 'rb') as file:
+        file.seek(offset)
+
+        while (True):
+            record = pickle.load(file)
+            if (record is None):
+                return
+
+            yield record
+
+# Yield (key, submission) pairs.
+def _iter_cached_submissions(cache_path, offset):
+    yield from _iter_cache_records(cache_path, offset)
+
+# Yield (key, groupset) pairs, where each groupset's 'groups' is a generator over the cached groups.
+# A groupset's groups must be consumed before moving on to the next groupset (any unconsumed groups are skipped).
+def _iter_cached_groupsets(cache_path, offset):
+    records = _iter_cache_records(cache_path, offset)
+    pending = {'record': next(records, None)}
+
+    def _iter_groups():
+        while (True):
+            record = next(records, None)
+            if ((record is None) or (record[0] != 'group')):
+                pending['record'] = record
+                return
+
+            yield record[1]
+
+    while (pending['record'] is not None):
+        (_, key, groupset) = pending['record']
+        pending['record'] = None
+
+        groups = _iter_groups()
+        groupset['groups'] = groups
+        yield (key, groupset)
+
+        # Skip any groups that the caller did not consume.
+        for _ in groups:
+            pass
+
+# Split an iterable into lists of (at most) the given size.
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if (len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+
+    if (len(chunk) > 0):
+        yield chunk
+
+# Get the peak resident memory of this process (in bytes).
+def get_peak_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KiB, macOS reports bytes.
+    if (sys.platform != 'darwin'):
+        peak *= 1024
+
+    return peak
+
+# Controls all API requests to Canvas:
+#  - retries transient failures (connection errors and some 5xx responses) with jittered exponential backoff,
+#  - backs off when Canvas throttles requests,
+#  - limits the number of in-flight requests, adapting the limit (additive increase, multiplicative decrease)
+#    to Canvas's rate-limit budget (X-Rate-Limit-Remaining) and the observed latency (per endpoint),
+#  - keeps counters on all of the above.
+# Throttled requests are always retried (Canvas did not process them),
+# other failures are only retried for requests that are safe to repeat.
+class RequestController:
+    def __init__(self, max_concurrency = 1, max_attempts = REQUEST_MAX_ATTEMPTS):
+        self._max_concurrency = max(1, max_concurrency)
+        self._max_attempts = max(1, max_attempts)
+
+        self._condition = threading.Condition()
+        self._limit = 1
+        self._in_flight = 0
+
+        # Responses to see before the limit can be raised again (or lowered again, after a decrease).
+        self._cooldown = 0
+        self._last_decreased = False
+
+        # {endpoint: [smoothed latency, best smoothed latency], ...}
+        self._latencies = {}
+
+        self._counters = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'connection_errors': 0,
+            'server_errors': 0,
+            'concurrency_increases': 0,
+            'concurrency_decreases': 0,
+            'peak_concurrency': 0,
+        }
+
+    def get_counters(self):
+        with self._condition:
+            return dict(self._counters, concurrency_limit = self._limit)
+
+    # Run a function over each item, with up to max_concurrency items in progress at once.
+    # The function is expected to make its requests through this controller.
+    # Results are returned in the same order as the items.
+    def map(self, function, items):
+        items = list(items)
+
+        recorder = get_plan_recorder()
+        if (recorder is not None):
+            return recorder.map(function, items)
+
+        if ((self._max_concurrency <= 1) or (len(items) <= 1)):
+            return [function(item) for item in items]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self._max_concurrency) as executor:
+            return list(executor.map(function, items))
+
+    # Make a request (with requests_function, e.g., requests.get) and return the final response.
+    # The response is returned as-is (even for error statuses) once no more retries are warranted.
+    def request(self, requests_function, url, retry = False, **kwargs):
+        attempt = 0
+        while (True):
+            attempt += 1
+            last_attempt = (attempt >= self._max_attempts)
+
+            self._acquire()
+            start_time = time.monotonic()
+            response = None
+            try:
+                response = requests_function(url, **kwargs)
+            except REQUEST_RETRY_EXCEPTIONS:
+                self._count('connection_errors')
+
+                if ((not retry) or last_attempt):
+                    raise
+            finally:
+                # Always give back the slot (even on unexpected errors), or other workers will wait on it forever.
+                self._release()
+
+            if (response is None):
+                self._backoff(attempt)
+                continue
+
+            latency = time.monotonic() - start_time
+
+            if (_is_throttled(response)):
+                self._count('throttled')
+                self._decrease()
+
+                if (last_attempt):
+                    return response
+
+                self._backoff(attempt, retry_after = response.headers.get('Retry-After', None))
+                continue
+
+            if (response.status_code in REQUEST_RETRY_STATUSES):
+                self._count('server_errors')
+
+                if (retry and (not last_attempt)):
+                    self._backoff(attempt, retry_after = response.headers.get('Retry-After', None))
+                    continue
+
+                return response
+
+            self._observe(url, response, latency)
+            return response
+
+    # Call a function that makes its own requests (e.g., through another library) and raises on failure,
+    # retrying the whole call on transient failures (see request()).
+    # The function is passed the attempt number (starting at 1).
+    def call(self, function, retry = True):
+        attempt = 0
+        while (True):
+            attempt += 1
+            last_attempt = (attempt >= self._max_attempts)
+
+            try:
+                return function(attempt)
+            except REQUEST_RETRY_EXCEPTIONS:
+                self._count('connection_errors')
+
+                if ((not retry) or last_attempt):
+                    raise
+
+                self._backoff(attempt)
+            except requests.exceptions.HTTPError as ex:
+                response = ex.response
+                if (response is None):
+                    raise
+
+                if (_is_throttled(response)):
+                    self._count('throttled')
+                    self._decrease()
+                elif (response.status_code in REQUEST_RETRY_STATUSES):
+                    self._count('server_errors')
+
+                    if (not retry):
+                        raise
+                else:
+                    raise
+
+                if (last_attempt):
+                    raise
+
+                self._backoff(attempt, retry_after = response.headers.get('Retry-After', None))
+
+    def _count(self, name, amount = 1):
+        with self._condition:
+            self._counters[name] += amount
+
+    def _acquire(self):
+        with self._condition:
+            while (self._in_flight >= self._limit):
+                self._condition.wait()
+
+            self._in_flight += 1
+            self._counters['requests'] += 1
+            self._counters['peak_concurrency'] = max(self._counters['peak_concurrency'], self._in_flight)
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def _backoff(self, attempt, retry_after = None):
+        self._count('retries')
+
+        # Full jitter.
+        max_delay = min(REQUEST_BACKOFF_MAX_SECS, REQUEST_BACKOFF_BASE_SECS * (2 ** (attempt - 1)))
+        delay = random.uniform(0, max_delay)
+
+        if (retry_after is not None):
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+
+        time.sleep(delay)
+
+    # Adjust the concurrency limit based on a successful response.
+    def _observe(self, url, response, latency):
+        endpoint = REQUEST_ENDPOINT_ID_PATTERN.sub('/:id', url.split('?')[0])
+
+        with self._condition:
+            stats = self._latencies.get(endpoint, None)
+            if (stats is None):
+                stats = [latency, latency]
+                self._latencies[endpoint] = stats
+            else:
+                stats[0] = (REQUEST_LATENCY_SMOOTHING * latency) + ((1.0 - REQUEST_LATENCY_SMOOTHING) * stats[0])
+                stats[1] = min(stats[1], stats[0])
+
+            remaining = _get_float_header(response, 'X-Rate-Limit-Remaining')
+            cost = _get_float_header(response, 'X-Request-Cost')
+
+            low_budget = False
+            if (remaining is not None):
+                # Leave room for every in-flight request to cost as much as this one.
+                reserve = RATE_LIMIT_LOW_WATERMARK + ((cost or 0.0) * self._limit)
+                low_budget = (remaining < reserve)
+
+            slow = (stats[0] > (REQUEST_LATENCY_BACKOFF_FACTOR * stats[1]))
+
+        if (low_budget or slow):
+            self._decrease()
+        else:
+            self._increase()
+
+    def _increase(self):
+        with self._condition:
+            if (self._cooldown > 0):
+                self._cooldown -= 1
+                return
+
+            if (self._limit >= self._max_concurrency):
+                return
+
+            self._limit += 1
+            self._cooldown = self._limit
+            self._last_decreased = False
+            self._counters['concurrency_increases'] += 1
+            self._condition.notify_all()
+
+    def _decrease(self):
+        with self._condition:
+            # Only one decrease per window, but a decrease can always follow an increase.
+            if (self._last_decreased and (self._cooldown > 0)):
+                self._cooldown -= 1
+                return
+
+            if (self._limit <= 1):
+                return
+
+            self._limit = max(1, self._limit // 2)
+            self._cooldown = self._limit
+            self._last_decreased = True
+            self._counters['concurrency_decreases'] += 1
+
+# Canvas signals throttling with a 403 (and a message) rather than a 429.
+def _is_throttled(response):
+    if (response.status_code == http.HTTPStatus.TOO_MANY_REQUESTS):
+        return True
+
+    return ((response.status_code == http.HTTPStatus.FORBIDDEN) and ('Rate Limit Exceeded' in response.text))
 
-    if (not get_records):
-        subprocess.run(f'psql -c "{sql}" {db}', shell = True, check = check)
+def _get_float_header(response, name):
+    value = response.headers.get(name, None)
+    if (value is None):
         return None
 
-    results = subprocess.run(f'psql --no-align --quiet --tuples-only -c "{sql}" {db}', shell = True, check = check, capture_output = True)
-    return results.stdout.decode('utf-8').splitlines()
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+_request_controller = RequestController()
+
+def get_request_controller():
+    return _request_controller
+
+def set_request_controller(controller):
+    global _request_controller
+    _request_controller = controller
 
 def get_default_headers(user):
     token = user.get('canvas_api_token', None)
@@ -142,18 +1006,25 @@ def make_canvas_get(user, endpoint, **kwargs):
 
 def make_canvas_post(user, endpoint, **kwargs):
     response = make_canvas_request(user, endpoint, requests_function = requests.post, **kwargs)
-    time.sleep(API_WRITE_WAIT_SECS)
+    if (get_plan_recorder() is None):
+        time.sleep(API_WRITE_WAIT_SECS)
+
     return response
 
 def make_canvas_put(user, endpoint, **kwargs):
     response = make_canvas_request(user, endpoint, requests_function = requests.put, **kwargs)
-    time.sleep(API_WRITE_WAIT_SECS)
+    if (get_plan_recorder() is None):
+        time.sleep(API_WRITE_WAIT_SECS)
+
     return response
 
+# Requests are made through the request controller.
+# Idempotent requests (by default, GETs and PUTs) are retried on transient failures.
+# When recording a load plan, the request is recorded and (None, <reference to the response body>) is returned.
 def make_canvas_request(user, endpoint,
-        data = None, headers = None, json_body = True,
+        data = None, files = None, headers = None, json_body = True,
         requests_function = requests.post,
-        api = True, default_heaaders = True):
+        api = True, default_heaaders = True, idempotent = None):
     if (data is None):
         data = {}
 
@@ -171,7 +1042,21 @@ def make_canvas_request(user, endpoint,
 
     url = f"{SERVER}/{endpoint}"
 
-    response = requests_function(url, headers = headers, data = data)
+    if (idempotent is None):
+        idempotent = (requests_function in (requests.get, requests.put))
+
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        method = [name for (name, function) in PLAN_HTTP_METHODS.items() if (function is requests_function)][0]
+
+        body = recorder.record('http', method = method, endpoint = endpoint,
+                data = data, files = files, headers = headers,
+                json_body = json_body, idempotent = idempotent)
+
+        return None, body
+
+    response = get_request_controller().request(requests_function, url, retry = idempotent,
+            headers = headers, data = data, files = files)
     response.raise_for_status()
 
     body = None
@@ -184,220 +1069,171 @@ def make_canvas_request(user, endpoint,
 
 def add_users(users):
     for user in users.values():
-        name = user['name']
-        email = user['email']
+        with plan_scope(f"user:{user['name']}"):
+            name = user['name']
+            email = user['email']
 
-        # The server owner is inserted on initial database population.
-        if (name == 'server-owner'):
-            continue
+            # The server owner is inserted on initial database population.
+            if (name == 'server-owner'):
+                continue
 
-        # First, create an account for the user, with the site admin as the parent.
-        data = {
-            'account[name]': name,
-            'account[sis_account_id]': email,
-        }
+            # First, create an account for the user, with the site admin as the parent.
+            data = {
+                'account[name]': name,
+                'account[sis_account_id]': email,
+            }
 
-        _, response_data = make_canvas_post(users['server-owner'], f"accounts/{SERVER_OWNER_ACCOUNT_ID}/sub_accounts", data = data)
-        user['canvas_account_id'] = response_data['id']
+            _, response_data = make_canvas_post(users['server-owner'], f"accounts/{SERVER_OWNER_ACCOUNT_ID}/sub_accounts", data = data)
+            user['canvas_account_id'] = response_data['id']
 
-        # Create a user for the new account.
-        data = {
-            'user[name]': name,
-            'user[short_name]': name,
-            'user[sortable_name]': name,
-            'user[terms_of_use]': True,
-            'user[skip_registration]': True,
-            'pseudonym[unique_id]': email,
-            'pseudonym[password]': name,
-            'pseudonym[sis_user_id]': email,
-            'pseudonym[integration_id]': email,
-            'pseudonym[send_confirmation]': False,
-            'pseudonym[force_self_registration]': False,
-            'force_validations': False,
-        }
+            # Create a user for the new account.
+            data = {
+                'user[name]': name,
+                'user[short_name]': name,
+                'user[sortable_name]': name,
+                'user[terms_of_use]': True,
+                'user[skip_registration]': True,
+                'pseudonym[unique_id]': email,
+                'pseudonym[password]': name,
+                'pseudonym[sis_user_id]': email,
+                'pseudonym[integration_id]': email,
+                'pseudonym[send_confirmation]': False,
+                'pseudonym[force_self_registration]': False,
+                'force_validations': False,
+            }
 
-        _, response_data = make_canvas_post(users['server-owner'], f"accounts/{user['canvas_account_id']}/users", data = data)
-        canvas_user_id = response_data['id']
+            _, response_data = make_canvas_post(users['server-owner'], f"accounts/{user['canvas_account_id']}/users", data = data)
+            canvas_user_id = response_data['id']
 
-        # Update the canvas ID to match ours.
-        _update_user_id(canvas_user_id, user['id'])
+            # Update the canvas ID to match ours.
+            _update_user_id(canvas_user_id, user['id'])
 
 def _delete_auditing_records(auditing_record_type):
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        recorder.record('delete_auditing_records', record_type = auditing_record_type)
+        return
+
+    session = get_sql_session()
+
     # Canvas is annoying and makes table names based on the current date, so we have to fetch the table names.
-    sql = f"""
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE
-            table_schema = 'public'
-            AND table_name LIKE 'auditor_{auditing_record_type}_records%'
-        ;
-    """
-    auditing_tables = run_sql(sql, get_records = True)
+    rows = session.execute('select_auditing_tables', (f"auditor_{auditing_record_type}_records%", ), get_records = True)
 
-    for auditing_table in auditing_tables:
-        run_sql(f"DELETE FROM {auditing_table};")
+    for (auditing_table, ) in rows:
+        session.execute_adhoc(psycopg2.sql.SQL('DELETE FROM {}').format(psycopg2.sql.Identifier('public', auditing_table)))
 
 def _update_user_id(old_id, new_id):
     _delete_auditing_records('authentication')
-
-    sql = f"""
-        WITH
-        access_tokens_fk_update_fk_update as (
-            UPDATE public.access_tokens
-            SET user_id = {new_id}
-            WHERE user_id = {old_id}
-        ),
-        account_users_fk_update as (
-            UPDATE public.account_users
-            SET user_id = {new_id}
-            WHERE user_id = {old_id}
-        ),
-        communication_channels_fk_update as (
-            UPDATE public.communication_channels
-            SET user_id = {new_id}
-            WHERE user_id = {old_id}
-        ),
-        pseudonyms_channels_fk_update as (
-            UPDATE public.pseudonyms
-            SET user_id = {new_id}
-            WHERE user_id = {old_id}
-        ),
-        user_account_associations_channels_fk_update as (
-            UPDATE public.user_account_associations
-            SET user_id = {new_id}
-            WHERE user_id = {old_id}
-        )
-        UPDATE public.users
-        SET id = {new_id}
-        WHERE id = {old_id}
-        ;
-    """
-    run_sql(sql)
+    get_sql_session().execute('update_user_id', (new_id, old_id))
 
 def add_courses(users, courses):
     account_id = users['server-owner']['canvas_account_id']
 
     for course in courses.values():
-        data = {
-            'course[name]': course['name'],
-            'course[course_code]': course['short-name'],
-            'course[is_public]': False,
-            'course[is_public_to_auth_users]': False,
-            'course[public_syllabus]': False,
-            'course[public_syllabus_to_auth]': False,
-            'course[allow_student_wiki_edits]': False,
-            'course[allow_wiki_comments]': False,
-            'course[allow_student_forum_attachments]': False,
-            'course[open_enrollment]': False,
-            'course[self_enrollment]': False,
-            'offer': True,
-            'enroll_me': False,
-            'skip_course_template': True,
-        }
+        with plan_scope(f"course:{course['id']}"):
+            data = {
+                'course[name]': course['name'],
+                'course[course_code]': course['short-name'],
+                'course[is_public]': False,
+                'course[is_public_to_auth_users]': False,
+                'course[public_syllabus]': False,
+                'course[public_syllabus_to_auth]': False,
+                'course[allow_student_wiki_edits]': False,
+                'course[allow_wiki_comments]': False,
+                'course[allow_student_forum_attachments]': False,
+                'course[open_enrollment]': False,
+                'course[self_enrollment]': False,
+                'offer': True,
+                'enroll_me': False,
+                'skip_course_template': True,
+            }
 
-        syllabus = course.get('syllabus', None)
-        if (syllabus is not None):
-            data['course[syllabus_body]'] = syllabus
-
-        _, response_data = make_canvas_post(users['server-owner'], f"accounts/{account_id}/courses", data = data)
-        canvas_course_id = response_data['id']
-
-        # Update ID.
-
-        _delete_auditing_records('course')
-
-        sql = f"""
-            WITH
-                course_account_associations_fk_update AS (
-                    UPDATE public.course_account_associations
-                    SET course_id = {course['id']}
-                    WHERE course_id = {canvas_course_id}
-                ),
-                post_policies_fk_update AS (
-                    UPDATE public.post_policies
-                    SET course_id = {course['id']}
-                    WHERE course_id = {canvas_course_id}
-                )
-            UPDATE public.courses
-            SET id = {course['id']}
-            WHERE id = {canvas_course_id}
-            ;
-        """
-        run_sql(sql)
+            syllabus = course.get('syllabus', None)
+            if (syllabus is not None):
+                data['course[syllabus_body]'] = syllabus
+
+            _, response_data = make_canvas_post(users['server-owner'], f"accounts/{account_id}/courses", data = data)
+            canvas_course_id = response_data['id']
+
+            # Update ID.
+
+            _delete_auditing_records('course')
+            get_sql_session().execute('update_course_id', (course['id'], canvas_course_id))
 
 def add_enrollments(users, courses):
     for user in users.values():
         for (course_name, enrollment_info) in user.get('course-info', {}).items():
-            role = enrollment_info['role']
+            with plan_scope(f"enrollment:{courses[course_name]['id']}:{user['name']}"):
+                role = enrollment_info['role']
 
-            data = {
-                'enrollment[user_id]': user['id'],
-                'enrollment[type]': COURSE_ROLE_ENROLLMENT_MAP[role],
-                'enrollment[enrollment_state]': 'active',
-                'enrollment[limit_privileges_to_course_section]': False,
-                'enrollment[notify]': False,
-            }
+                data = {
+                    'enrollment[user_id]': user['id'],
+                    'enrollment[type]': COURSE_ROLE_ENROLLMENT_MAP[role],
+                    'enrollment[enrollment_state]': 'active',
+                    'enrollment[limit_privileges_to_course_section]': False,
+                    'enrollment[notify]': False,
+                }
 
-            make_canvas_post(users['server-owner'], f"courses/{courses[course_name]['id']}/enrollments", data = data)
+                make_canvas_post(users['server-owner'], f"courses/{courses[course_name]['id']}/enrollments", data = data)
 
 def add_assignments(users, assignments, courses):
     for assignment in assignments.values():
-        course_name = assignment['course']
+        with plan_scope(f"assignment:{assignment['id']}"):
+            course_name = assignment['course']
 
-        # Get the submission type and skip assignments without a submission type,
-        # which includes things like quizzes (which are handled separately).
-        submission_type = ASSIGNMENT_SUBMISSION_TYPE_MAP.get(assignment.get('type', None), None)
-        if (submission_type is None):
-            continue
+            # Get the submission type and skip assignments without a submission type,
+            # which includes things like quizzes (which are handled separately).
+            submission_type = ASSIGNMENT_SUBMISSION_TYPE_MAP.get(assignment.get('type', None), None)
+            if (submission_type is None):
+                continue
 
-        data = {
-            'assignment[name]': assignment['name'],
-            'assignment[submission_types][]': submission_type,
-            'assignment[published]': True,
-            'assignment[points_possible]': assignment['max-points'],
-            'assignment[turnitin_enabled]': False,
-            'assignment[vericite_enabled]': False,
-            'assignment[peer_reviews]': False,
-            'assignment[automatic_peer_reviews]': False,
-            'assignment[notify_of_update]': False,
-            'assignment[allowed_attempts]': -1,
-            'assignment[grading_type]': 'points',
-            'assignment[only_visible_to_overrides]': False,
-            'assignment[omit_from_final_grade]': False,
-            'assignment[moderated_grading]': False,
-
-            # For some reason, some listed options give a 400.
-            # 'assignment[quiz_lti]': False,
-            # 'assignment[hide_in_gradebook]': False,
-        }
+            data = {
+                'assignment[name]': assignment['name'],
+                'assignment[submission_types][]': submission_type,
+                'assignment[published]': True,
+                'assignment[points_possible]': assignment['max-points'],
+                'assignment[turnitin_enabled]': False,
+                'assignment[vericite_enabled]': False,
+                'assignment[peer_reviews]': False,
+                'assignment[automatic_peer_reviews]': False,
+                'assignment[notify_of_update]': False,
+                'assignment[allowed_attempts]': -1,
+                'assignment[grading_type]': 'points',
+                'assignment[only_visible_to_overrides]': False,
+                'assignment[omit_from_final_grade]': False,
+                'assignment[moderated_grading]': False,
+
+                # For some reason, some listed options give a 400.
+                # 'assignment[quiz_lti]': False,
+                # 'assignment[hide_in_gradebook]': False,
+            }
 
-        _, response_data = make_canvas_post(users['server-owner'], f"courses/{courses[course_name]['id']}/assignments", data = data)
-        canvas_assignment_id = response_data['id']
-
-        # Update ID.
-
-        sql = f"""
-            WITH
-                post_policies_fk_update AS (
-                    UPDATE public.post_policies
-                    SET assignment_id = {assignment['id']}
-                    WHERE assignment_id = {canvas_assignment_id}
-                ),
-
-                submissions_fk_update AS (
-                    UPDATE public.submissions
-                    SET assignment_id = {assignment['id']}
-                    WHERE assignment_id = {canvas_assignment_id}
-                )
-            UPDATE public.assignments
-            SET id = {assignment['id']}
-            WHERE id = {canvas_assignment_id}
-            ;
-        """
-        run_sql(sql)
-
-def add_submissions(users, courses, assignments, submissions):
-    for submission in submissions.values():
+            _, response_data = make_canvas_post(users['server-owner'], f"courses/{courses[course_name]['id']}/assignments", data = data)
+            canvas_assignment_id = response_data['id']
+
+            # Update ID.
+
+            get_sql_session().execute('update_assignment_id', (assignment['id'], canvas_assignment_id))
+
+# Submissions may be any iterable of submission dicts (e.g., a stream from the dataset cache).
+# Submissions are processed in chunks so that the per-submission DB fix-ups share a single auditing cleanup.
+def add_submissions(users, courses, assignments, submissions, chunk_size = DEFAULT_STREAM_CHUNK_SIZE):
+    controller = get_request_controller()
+
+    for chunk in iter_chunks(submissions, chunk_size):
+        # Only the per-chunk ops are keyed by the chunk (and so are re-keyed when chunk boundaries move),
+        # each submission's own ops are keyed by just the submission.
+        with plan_scope(f"submissions:{chunk[0]['id']}"):
+            controller.map(lambda submission: _add_submission(users, courses, assignments, submission), chunk)
+
+            _delete_auditing_records('grade_change')
+
+            # Canvas does not allow all the values we need to be set, so manually set them in the DB along with the ID.
+            params_list = [_get_submission_update_params(users, assignments, submission) for submission in chunk]
+            get_sql_session().execute_many('update_submission', params_list)
+
+def _add_submission(users, courses, assignments, submission):
+    with plan_scope(f"submission:{submission['id']}", root = True):
         canvas_course_id = courses[submission['course']]['id']
         canvas_assignment_id = assignments[submission['assignment']]['id']
         user_id = users[submission['user']]['id']
@@ -409,77 +1245,137 @@ def add_submissions(users, courses, assignments, submissions):
 
         make_canvas_put(users['server-owner'], f"courses/{canvas_course_id}/assignments/{canvas_assignment_id}/submissions/{user_id}", data = data)
 
-        _delete_auditing_records('grade_change')
+# Get the params for the 'update_submission' statement.
+def _get_submission_update_params(users, assignments, submission):
+    canvas_assignment_id = assignments[submission['assignment']]['id']
+    user_id = users[submission['user']]['id']
+
+    # Canvas does not allow many dates to be set, so we have to manually set them in the DB.
+    # Timestamps are msecs, the DB wants secs.
+    submitted_at = None
+    grading_start_time = submission.get('grading-start-time', None)
+    if (grading_start_time is not None):
+        submitted_at = grading_start_time / 1000
+
+    graded_at = None
+    grading_end_time = submission.get('grading-end-time', None)
+    if (grading_end_time is not None):
+        graded_at = grading_end_time / 1000
+
+    return (submission['id'], submitted_at, graded_at, canvas_assignment_id, user_id)
+
+# Groupsets may be any iterable of groupset dicts (e.g., a stream from the dataset cache).
+# If bulk is true, all of a groupset's groups and memberships will be created with a single CSV import
+# (instead of one request per group and per membership).
+def add_groups(users, courses, assignments, groupsets, bulk = False):
+    for groupset in groupsets:
+        with plan_scope(f"groupset:{groupset['id']}"):
+            canvas_course_id = courses[groupset['course']]['id']
+            canvas_assignment_id = assignments[groupset['assignment']]['id']
 
-        # Canvas does not allow all the values we need to be set, so manually set them in the DB along with the ID.
-        set_values = {'id': submission['id']}
-
-        # Canvas does not allow many dates to be set, so we have to manually set them in the DB.
-        grading_start_time = submission.get('grading-start-time', None)
-        grading_end_time = submission.get('grading-end-time', None)
+            data = {
+                'name': groupset['name'],
+                'create_group_count': 0,
+            }
 
-        if (grading_start_time is not None):
-            set_values['submitted_at'] = f"TO_TIMESTAMP({grading_start_time / 1000})"
+            _, response_data = make_canvas_post(users['course-owner'], f"courses/{canvas_course_id}/group_categories", data = data)
+            temp_canvas_groupset_id = response_data['id']
 
-        if (grading_end_time is not None):
-            set_values['graded_at'] = f"TO_TIMESTAMP({grading_end_time / 1000})"
-            set_values['posted_at'] = f"TO_TIMESTAMP({grading_end_time / 1000})"
+            get_sql_session().execute('update_groupset_id', (groupset['id'], temp_canvas_groupset_id))
 
-        set_sql = ', '.join([f"{field} = {value}" for (field, value) in set_values.items()])
+            if (bulk):
+                _import_groups(users, groupset)
+                continue
 
-        sql = f"""
-            UPDATE public.submissions
-            SET {set_sql}
-            WHERE
-                assignment_id = {canvas_assignment_id}
-                AND user_id = {user_id}
-            ;
-        """
+            for group in groupset['groups']:
+                _add_group(users, group, groupset)
 
-        run_sql(sql)
+# Create all the groups (and memberships) in a groupset via a group category CSV import,
+# and then update all the group IDs at once.
+# Groups are matched up by name after the import, so names must be unique within the groupset.
+# The records created by the import itself are removed afterwards.
+def _import_groups(users, groupset):
+    # Groups may be a (one-shot) stream, but one groupset's groups are small enough to hold.
+    groups = list(groupset['groups'])
 
-def add_groups(users, courses, assignments, groupsets):
-    for groupset in groupsets.values():
-        canvas_course_id = courses[groupset['course']]['id']
-        canvas_assignment_id = assignments[groupset['assignment']]['id']
+    seen_names = set()
+    for group in groups:
+        if (group['name'] in seen_names):
+            raise ValueError(f"Groupset '{groupset['name']}' has more than one group named '{group['name']}',"
+                + " which cannot be imported in bulk.")
 
-        data = {
-            'name': groupset['name'],
-            'create_group_count': 0,
-        }
+        seen_names.add(group['name'])
 
-        _, response_data = make_canvas_post(users['course-owner'], f"courses/{canvas_course_id}/group_categories", data = data)
-        temp_canvas_groupset_id = response_data['id']
+    group_names = []
+    group_ids = []
 
-        sql = f"""
-            UPDATE public.group_categories
-            SET id = {groupset['id']}
-            WHERE id = {temp_canvas_groupset_id}
-            ;
-        """
-        run_sql(sql)
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer, lineterminator = '\n')
+    writer.writerow(['canvas_user_id', 'group_name'])
 
-        for group in groupset['groups']:
+    for group in groups:
+        # Imports can only create groups that have members.
+        if (len(group['users']) == 0):
             _add_group(users, group, groupset)
+            continue
 
-def _add_group(users, group, groupset):
-    data = {
-        'name': group['name'],
+        group_names.append(group['name'])
+        group_ids.append(group['id'])
+
+        for user_name in group['users']:
+            writer.writerow([users[user_name]['id'], group['name']])
+
+    if (len(group_names) == 0):
+        return
+
+    files = {
+        'attachment': (f"{groupset['id']}.csv", csv_buffer.getvalue(), 'text/csv'),
     }
 
-    _, response_data = make_canvas_post(users['course-owner'], f"group_categories/{groupset['id']}/groups", data = data)
-    temp_canvas_group_id = response_data['id']
+    _, response_data = make_canvas_post(users['course-owner'], f"group_categories/{groupset['id']}/import", files = files)
+    wait_for_progress(users['course-owner'], response_data['id'])
 
-    sql = f"""
-        UPDATE public.groups
-        SET id = {group['id']}
-        WHERE id = {temp_canvas_group_id}
-        ;
-    """
-    run_sql(sql)
+    sql_session = get_sql_session()
+    sql_session.execute('update_group_ids_by_name', (groupset['id'], group_names, group_ids))
+    sql_session.execute('delete_group_import_records', (groupset['id'],))
+    sql_session.execute('reset_group_import_sequences')
+
+# Wait for a background job (tracked by a progress object) to complete.
+def wait_for_progress(user, progress_id):
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        recorder.record('progress', token = user['canvas_api_token'], progress_id = progress_id)
+        return
+
+    for _ in range(GROUP_IMPORT_WAIT_ATTEMPTS):
+        _, response_data = make_canvas_get(user, f"progress/{progress_id}")
+
+        state = response_data['workflow_state']
+        if (state == PROGRESS_STATE_COMPLETED):
+            return
+
+        if (state == PROGRESS_STATE_FAILED):
+            raise ValueError(f"Canvas job (progress '{progress_id}') failed: '{response_data.get('message', None)}'.")
+
+        time.sleep(GROUP_IMPORT_WAIT_TIME_SECS)
+
+    raise ValueError(f"Canvas job (progress '{progress_id}') did not complete after {GROUP_IMPORT_WAIT_ATTEMPTS} checks.")
+
+def _add_group(users, group, groupset):
+    with plan_scope(f"group:{group['id']}"):
+        data = {
+            'name': group['name'],
+        }
+
+        _, response_data = make_canvas_post(users['course-owner'], f"group_categories/{groupset['id']}/groups", data = data)
+        temp_canvas_group_id = response_data['id']
 
-    for user_name in group['users']:
+        get_sql_session().execute('update_group_id', (group['id'], temp_canvas_group_id))
 
+        get_request_controller().map(lambda user_name: _add_group_membership(users, group, user_name), group['users'])
+
+def _add_group_membership(users, group, user_name):
+    with plan_scope(f"membership:{user_name}"):
         data = {
             'user_id': users[user_name]['id']
         }
@@ -489,10 +1385,16 @@ def _add_group(users, group, groupset):
 # Log in using the web interface and create an API token.
 # An 'canvas_api_token' field will be added to the user.
 def create_api_token(user):
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        user['canvas_api_token'] = recorder.record('token', email = user['email'], password = user['password'])['token']
+        return
+
+    controller = get_request_controller()
     session = requests.Session()
 
     # Go to the login page to set initial cookies.
-    response = session.get(f"{SERVER}/login/canvas")
+    response = controller.request(session.get, f"{SERVER}/login/canvas", retry = True)
     response.raise_for_status()
 
     csrf_token = _parse_csrf_token(response)
@@ -508,7 +1410,8 @@ def create_api_token(user):
         'pseudonym_session[remember_me]': '0',
     }
 
-    response = session.post(f"{SERVER}/login/canvas", data = data)
+    # Logging in again is harmless, so this is safe to retry.
+    response = controller.request(session.post, f"{SERVER}/login/canvas", retry = True, data = data)
     response.raise_for_status()
 
     # Create a token.
@@ -523,7 +1426,7 @@ def create_api_token(user):
         'x-csrf-token': csrf_token,
     }
 
-    response = session.post(f"{SERVER}/api/v1/users/self/tokens", data = data, headers = headers)
+    response = controller.request(session.post, f"{SERVER}/api/v1/users/self/tokens", data = data, headers = headers)
     response.raise_for_status()
 
     data = response.json()
@@ -547,23 +1450,20 @@ def _parse_csrf_token(response):
 
 # Replace users' existing tokens with static ones.
 def replace_tokens(users):
+    params_list = []
     for (name, user) in users.items():
         token_info = STATIC_TOKENS.get(name, None)
         if (token_info is None):
             continue
 
-        sql = f"""
-            UPDATE public.access_tokens
-            SET
-                crypted_token = '{token_info['crypted_token']}',
-                token_hint = '{token_info['token_hint']}',
-                crypted_refresh_token = '{token_info['crypted_refresh_token']}'
-            WHERE
-                user_id = {user['id']}
-            ;
-        """
+        params_list.append((
+            token_info['crypted_token'],
+            token_info['token_hint'],
+            token_info['crypted_refresh_token'],
+            user['id'],
+        ))
 
-        run_sql(sql)
+    get_sql_session().execute_many('replace_token', params_list)
 
 # Upload quizzes to Canvas.
 def add_quizzes(users, courses, assignments):
@@ -571,83 +1471,366 @@ def add_quizzes(users, courses, assignments):
         if (quiz_data['type'] != 'quiz'):
             continue
 
-        token = users['course-owner']['canvas_api_token']
-        course_id = courses[quiz_data['course']]['id']
+        with plan_scope(f"quiz:{quiz_data['id']}"):
+            token = users['course-owner']['canvas_api_token']
+            course_id = courses[quiz_data['course']]['id']
+
+            _upload_quiz(token, course_id, quiz_data['relpath'])
+
+            # Update Quiz ID
 
-        quiz_path = os.path.join(LMS_TESTDATA_DIR, quiz_data['relpath'])
-        quiz = quizcomp.quiz.Quiz.from_path(quiz_path)
-        canvas_instance = quizcomp.uploader.canvas.InstanceInfo(SERVER, course_id, token)
+            session = get_sql_session()
 
-        uploader = quizcomp.uploader.canvas.CanvasUploader(canvas_instance)
+            rows = session.execute('select_quiz_id', (quiz_data['name'], ), get_records = True)
+            old_quiz_id = rows[0][0]
+
+            session.execute('update_quiz_id', (quiz_data['id'], old_quiz_id))
+
+            # Update Quiz Question IDs
+
+            session.execute('offset_quiz_question_ids', (quiz_data['id'], ))
+
+            # Reset the assesment questions sequence.
+            session.execute('reset_assessment_questions_sequence')
+
+# Upload a quiz (relpath is relative to the lms-testdata directory).
+def _upload_quiz(token, course_id, relpath):
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        recorder.record('quiz', token = token, course_id = course_id, relpath = relpath)
+        return
+
+    quiz_path = os.path.join(LMS_TESTDATA_DIR, relpath)
+    quiz = quizcomp.quiz.Quiz.from_path(quiz_path)
+    canvas_instance = quizcomp.uploader.canvas.InstanceInfo(SERVER, course_id, token)
+
+    # The uploader makes its own requests, so retry the whole upload.
+    # A retry replaces (deletes) any partially uploaded copy of the quiz.
+    def _upload(attempt):
+        if (attempt > 1):
+            print(f"WARNING: Retrying the upload of quiz '{quiz.title}', quiz question IDs may differ from a clean build.")
+
+        uploader = quizcomp.uploader.canvas.CanvasUploader(canvas_instance, force = (attempt > 1))
         uploader.upload_quiz(quiz)
 
-        # Update Quiz ID
+    get_request_controller().call(_upload)
 
-        sql = f"""
-            SELECT id
-            FROM public.quizzes
-            WHERE title = '{quiz_data['name']}'
-            ;
-        """
-        lines = run_sql(sql, get_records = True)
+# A reference to (part of) the result of an earlier operation in a load plan.
+# When formatted into a string (e.g., an endpoint or header), it becomes a placeholder like '${user:course-owner/post-users.id}'
+# that is filled in when the plan is executed.
+class PlanRef:
+    def __init__(self, op_key, path = ()):
+        self.op_key = op_key
+        self.path = tuple(path)
 
-        old_quiz_id = lines[0]
+    def __getitem__(self, key):
+        return PlanRef(self.op_key, self.path + (key, ))
 
-        sql = f"""
-            WITH
-            quiz_groups_fk_update as (
-                UPDATE public.quiz_groups
-                SET quiz_id = {quiz_data['id']}
-                WHERE quiz_id = {old_quiz_id}
-            ),
-            quiz_questions_fk_update as (
-                UPDATE public.quiz_questions
-                SET quiz_id = {quiz_data['id']}
-                WHERE quiz_id = {old_quiz_id}
-            )
-            UPDATE public.quizzes
-            SET id = {quiz_data['id']}
-            WHERE id = {old_quiz_id}
-            ;
-        """
-        run_sql(sql)
-
-        # Update Quiz Question IDs
-
-        sql = f"""
-            WITH
-            quiz_groups_id_update as (
-                UPDATE public.quiz_groups
-                SET id = (id + {quiz_data['id']})
-                WHERE quiz_id = {quiz_data['id']}
-            ),
-            quiz_questions_id_update as (
-                UPDATE public.quiz_questions
-                SET
-                    id = (id + {quiz_data['id']}),
-                    quiz_group_id = (quiz_group_id + {quiz_data['id']}),
-                    assessment_question_id = (assessment_question_id + {quiz_data['id']})
-                WHERE quiz_id = {quiz_data['id']}
-            ),
-            attachments_contextid_update as (
-                UPDATE public.attachments
-                SET context_id = (context_id + {quiz_data['id']})
-                WHERE
-                    context_type = 'AssessmentQuestion'
-                    AND context_id < 10000
-            )
-            UPDATE public.assessment_questions
-            SET id = (id + {quiz_data['id']})
-            WHERE id < 10000
-            ;
-        """
-        run_sql(sql)
+    def __str__(self):
+        return '${' + '.'.join([self.op_key] + [str(part) for part in self.path]) + '}'
+
+    def __format__(self, format_spec):
+        return str(self)
+
+# Records the operations (HTTP requests, SQL statements, etc.) that loading would perform into an ordered plan,
+# instead of performing them.
+# Each op is keyed by the scopes it was recorded in (see plan_scope(), e.g., 'user:course-owner')
+# and a label for what it does (e.g., 'post-users' or 'update_user_id'),
+# so that changing one part of the dataset does not change the keys (or references) of unrelated ops.
+# Ops recorded within map() (e.g., one per submission) are independent of each other,
+# and are marked with a parallel group (and a unit per item) so the executor can run them concurrently.
+class PlanRecorder:
+    def __init__(self):
+        self.ops = []
+
+        self._keys = set()
+        self._scopes = []
+
+        self._group = None
+        self._unit = None
+
+    # If root is true, the scope is not nested in the current scopes.
+    @contextlib.contextmanager
+    def scope(self, name, root = False):
+        outer_scopes = self._scopes
+
+        self._scopes = ([] if root else list(outer_scopes)) + [PLAN_KEY_INVALID_PATTERN.sub('_', str(name))]
+        try:
+            yield
+        finally:
+            self._scopes = outer_scopes
+
+    def record(self, op_type, **fields):
+        op = {
+            'key': self._make_key(op_type, fields),
+            'type': op_type,
+        }
+        op.update(fields)
+        op['deps'] = sorted(_find_plan_deps(fields))
+
+        if (self._group is not None):
+            op['parallel_group'] = self._group
+            op['parallel_unit'] = self._unit
+
+        self.ops.append(op)
+        return PlanRef(op['key'])
+
+    def _make_key(self, op_type, fields):
+        label = op_type
+        if (op_type == 'http'):
+            # The method and the last (non-ID) part of the endpoint, e.g., 'post-enrollments'.
+            parts = [part for part in PLAN_REF_PATTERN.sub('', fields['endpoint']).split('/') if ((part != '') and (not part.isdigit()))]
+            label = f"{fields['method'].lower()}-{parts[-1]}"
+        elif (op_type in ('sql', 'sql_many')):
+            label = fields['statement']
+
+        return self._make_unique_key('/'.join(self._scopes + [PLAN_KEY_INVALID_PATTERN.sub('_', label)]))
+
+    def _make_unique_key(self, base_key):
+        key = base_key
+        count = 1
+        while (key in self._keys):
+            count += 1
+            key = f"{base_key}#{count}"
+
+        self._keys.add(key)
+        return key
+
+    def map(self, function, items):
+        if (self._group is not None):
+            return [function(item) for item in items]
 
-        # Reset the assesment questions sequence.
-        run_sql("SELECT pg_catalog.setval('public.assessment_questions_id_seq', 1, true);")
+        # Parallel groups are keyed like ops.
+        self._group = self._make_unique_key('/'.join(self._scopes + ['map']))
+
+        try:
+            results = []
+            for (unit, item) in enumerate(items):
+                self._unit = unit
+                results.append(function(item))
+
+            return results
+        finally:
+            self._group = None
+            self._unit = None
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'ops': self.ops,
+        }
+
+# Stands in for a SQLSession while recording a plan.
+class PlanSQLSession:
+    def __init__(self, recorder):
+        self._recorder = recorder
+
+    def execute(self, name, params = (), get_records = False):
+        return self._recorder.record('sql', statement = name, params = list(params), get_records = get_records)
+
+    def execute_many(self, name, params_list, page_size = SQL_BATCH_SIZE):
+        params_list = [list(params) for params in params_list]
+        if (len(params_list) == 0):
+            return
+
+        self._recorder.record('sql_many', statement = name, params_list = params_list)
+
+_plan_recorder = None
+
+def get_plan_recorder():
+    return _plan_recorder
+
+def set_plan_recorder(recorder):
+    global _plan_recorder
+    _plan_recorder = recorder
+
+# Name the plan ops recorded within this block (see PlanRecorder.scope()).
+# Does nothing when a plan is not being recorded.
+@contextlib.contextmanager
+def plan_scope(name, root = False):
+    recorder = get_plan_recorder()
+    if (recorder is None):
+        yield
+        return
+
+    with recorder.scope(name, root = root):
+        yield
+
+# Get the keys of all the ops referenced in a value.
+def _find_plan_deps(value):
+    deps = set()
+
+    if (isinstance(value, PlanRef)):
+        deps.add(value.op_key)
+    elif (isinstance(value, str)):
+        deps.update([match.group(1) for match in PLAN_REF_PATTERN.finditer(value)])
+    elif (isinstance(value, dict)):
+        for item in value.values():
+            deps.update(_find_plan_deps(item))
+    elif (isinstance(value, (list, tuple))):
+        for item in value:
+            deps.update(_find_plan_deps(item))
+
+    return deps
+
+def write_plan(path, recorder):
+    with open(path, 'w') as file:
+        json.dump(recorder.to_dict(), file, indent = 4, sort_keys = True, default = str)
+        file.write("\n")
+
+def read_plan(path):
+    with open(path, 'r') as file:
+        plan = json.load(file)
+
+    if (plan.get('version', None) != PLAN_VERSION):
+        raise ValueError(f"Load plan '{path}' has version '{plan.get('version', None)}', expected '{PLAN_VERSION}'.")
+
+    return plan
+
+# Execute a load plan (in order).
+# Runs of ops that share a parallel group are run concurrently (one unit at a time per worker)
+# through the request controller.
+def execute_plan(plan):
+    ops = plan['ops']
+    results = {}
+
+    index = 0
+    while (index < len(ops)):
+        group = ops[index].get('parallel_group', None)
+        if (group is None):
+            results[ops[index]['key']] = _execute_plan_op(ops[index], results)
+            index += 1
+            continue
+
+        end = index
+        units = {}
+        while ((end < len(ops)) and (ops[end].get('parallel_group', None) == group)):
+            units.setdefault(ops[end]['parallel_unit'], []).append(ops[end])
+            end += 1
+
+        group_keys = {op['key'] for op in ops[index:end]}
+        for unit_ops in units.values():
+            unit_keys = {op['key'] for op in unit_ops}
+            for op in unit_ops:
+                for dep in op['deps']:
+                    if ((dep in group_keys) and (dep not in unit_keys)):
+                        raise ValueError(f"Op '{op['key']}' depends on op '{dep}' in the same parallel group.")
+
+        for unit_results in get_request_controller().map(lambda unit_ops: _execute_plan_unit(unit_ops, results), units.values()):
+            results.update(unit_results)
+
+        index = end
+
+def _execute_plan_unit(unit_ops, results):
+    unit_results = {}
+    for op in unit_ops:
+        unit_results[op['key']] = _execute_plan_op(op, dict(results, **unit_results))
+
+    return unit_results
+
+def _execute_plan_op(op, results):
+    op_type = op['type']
+
+    if (op_type == 'wait_for_server'):
+        wait_for_server()
+        return None
+
+    if (op_type == 'token'):
+        user = {
+            'email': op['email'],
+            'password': op['password'],
+        }
+
+        create_api_token(user)
+        return {'token': user['canvas_api_token']}
+
+    if (op_type == 'http'):
+        files = _resolve_plan_value(op['files'], results)
+        if (files is not None):
+            files = {name: tuple(info) for (name, info) in files.items()}
+
+        requests_function = PLAN_HTTP_METHODS[op['method']]
+
+        _, body = make_canvas_request(None, _resolve_plan_value(op['endpoint'], results),
+                data = _resolve_plan_value(op['data'], results),
+                files = files,
+                headers = _resolve_plan_value(op['headers'], results),
+                json_body = op['json_body'],
+                requests_function = requests_function,
+                api = False, default_heaaders = False,
+                idempotent = op['idempotent'])
+
+        if (requests_function is not requests.get):
+            time.sleep(API_WRITE_WAIT_SECS)
+
+        return body
+
+    if (op_type == 'sql'):
+        rows = get_sql_session().execute(op['statement'], _resolve_plan_value(op['params'], results), get_records = op['get_records'])
+        if (rows is None):
+            return None
+
+        return [list(row) for row in rows]
+
+    if (op_type == 'sql_many'):
+        get_sql_session().execute_many(op['statement'], _resolve_plan_value(op['params_list'], results))
+        return None
+
+    if (op_type == 'delete_auditing_records'):
+        _delete_auditing_records(op['record_type'])
+        return None
+
+    if (op_type == 'progress'):
+        user = {'canvas_api_token': _resolve_plan_value(op['token'], results)}
+        wait_for_progress(user, _resolve_plan_value(op['progress_id'], results))
+        return None
+
+    if (op_type == 'quiz'):
+        _upload_quiz(_resolve_plan_value(op['token'], results), _resolve_plan_value(op['course_id'], results), op['relpath'])
+        return None
+
+    raise ValueError(f"Unknown load plan op type: '{op_type}'.")
+
+# Fill in all the references (see PlanRef) in a value.
+# A string that is exactly one reference is replaced with the referenced value (keeping its type).
+def _resolve_plan_value(value, results):
+    if (isinstance(value, str)):
+        match = PLAN_REF_PATTERN.fullmatch(value)
+        if (match is not None):
+            return _lookup_plan_ref(match, results)
+
+        return PLAN_REF_PATTERN.sub(lambda match: str(_lookup_plan_ref(match, results)), value)
+
+    if (isinstance(value, dict)):
+        return {key: _resolve_plan_value(item, results) for (key, item) in value.items()}
+
+    if (isinstance(value, list)):
+        return [_resolve_plan_value(item, results) for item in value]
+
+    return value
+
+def _lookup_plan_ref(match, results):
+    value = results[match.group(1)]
+
+    path = match.group(2)
+    if (path == ''):
+        return value
+
+    for part in path[1:].split('.'):
+        if (isinstance(value, list)):
+            part = int(part)
+
+        value = value[part]
+
+    return value
 
 # wait for the server to respond.
 def wait_for_server():
+    recorder = get_plan_recorder()
+    if (recorder is not None):
+        recorder.record('wait_for_server')
+        return
+
     for _ in range(START_WAIT_ATTEMPTS):
         try:
             response = requests.get(SERVER)
@@ -662,42 +1845,144 @@ def wait_for_server():
 
     raise ValueError(f"Server has not responded properly at startup after {START_WAIT_ATTEMPTS} tries.")
 
-def main():
-    # The Python pathing makes it easier to load this dynamically.
-    dataset = edq.util.pyimport.import_path(LOAD_SCRIPT).load_test_data(DATA_DIR)
-    (users, courses, assignments, groupsets, submissions) = dataset
+def run_cli(args):
+    set_request_controller(RequestController(max_concurrency = args.max_concurrency, max_attempts = args.max_attempts))
+
+    if ((args.plan_in is not None) and (args.plan_out is not None)):
+        raise ValueError("Only one of --plan-in and --plan-out may be used.")
+
+    if (args.plan_in is not None):
+        execute_plan(read_plan(args.plan_in))
+    else:
+        cache_path = args.dataset_cache
+        if (args.no_dataset_cache):
+            cache_path = None
+
+            if (args.stream):
+                print("WARNING: Streaming without a dataset cache still parses the full dataset into memory on every run."
+                    + " Use a dataset cache to benefit from streaming.")
+
+        dataset = load_dataset(args.data_dir, cache_path = cache_path, key_type = args.dataset_cache_key, stream = args.stream)
+        (users, courses, assignments, groupsets, submissions) = dataset
+
+        if (not args.stream):
+            groupsets = groupsets.values()
+            submissions = submissions.values()
+
+        if (args.plan_out is not None):
+            set_plan_recorder(PlanRecorder())
+
+        load_data(users, courses, assignments, groupsets, submissions,
+                chunk_size = args.stream_chunk_size, bulk_groups = args.bulk_groups)
+
+        if (args.plan_out is not None):
+            recorder = get_plan_recorder()
+            write_plan(args.plan_out, recorder)
+            print(f"Wrote load plan ({len(recorder.ops)} ops) to '{args.plan_out}'.")
+            return 0
+
+    peak_note = ''
+    if (_dataset_parsed):
+        peak_note = ' (includes fully parsing the dataset, not just the streaming footprint)'
 
+    print(f"Peak memory usage: {get_peak_memory() / (1024 * 1024):.1f} MiB{peak_note}.")
+
+    counters = get_request_controller().get_counters()
+    print("Request stats: " + ', '.join([f"{name} = {value}" for (name, value) in counters.items()]) + '.')
+
+    return 0
+
+def load_data(users, courses, assignments, groupsets, submissions,
+        chunk_size = DEFAULT_STREAM_CHUNK_SIZE, bulk_groups = False):
     wait_for_server()
     print("Server is ready for data loading.")
 
-    # Add in the server owner's info manually.
-    # This is done for other users in add_users() (when they are created).
-    users['server-owner']['canvas_account_id'] = SERVER_OWNER_ACCOUNT_ID
-    _update_user_id(SERVER_OWNER_USER_ID, users['server-owner']['id'])
+    with plan_scope('user:server-owner'):
+        # Add in the server owner's info manually.
+        # This is done for other users in add_users() (when they are created).
+        users['server-owner']['canvas_account_id'] = SERVER_OWNER_ACCOUNT_ID
+        _update_user_id(SERVER_OWNER_USER_ID, users['server-owner']['id'])
 
-    # Create an API token for server-owner.
-    create_api_token(users['server-owner'])
+        # Create an API token for server-owner.
+        create_api_token(users['server-owner'])
 
     # Add the users.
     add_users(users)
 
     # Create tokens for all other users.
     for name, user in users.items():
-        if (name != 'server-owner'):
-            create_api_token(user)
+        with plan_scope(f"user:{name}"):
+            if (name != 'server-owner'):
+                create_api_token(user)
 
     # Add the non-user information.
     add_courses(users, courses)
     add_enrollments(users, courses)
     add_assignments(users, assignments, courses)
-    add_submissions(users, courses, assignments, submissions)
-    add_groups(users, courses, assignments, groupsets)
+    add_submissions(users, courses, assignments, submissions, chunk_size = chunk_size)
+    add_groups(users, courses, assignments, groupsets, bulk = bulk_groups)
     add_quizzes(users, courses, assignments)
 
     # Replace the created tokens with static values.
-    replace_tokens(users)
+    with plan_scope('tokens'):
+        replace_tokens(users)
 
-    return 0
+def main():
+    return run_cli(_get_parser().parse_args())
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+
+    parser.add_argument('--data-dir', dest = 'data_dir',
+        action = 'store', type = str, default = DATA_DIR,
+        help = 'The directory with the test data to load (default: %(default)s).')
+
+    parser.add_argument('--dataset-cache', dest = 'dataset_cache',
+        action = 'store', type = str, default = DEFAULT_DATASET_CACHE_PATH,
+        help = 'Where to cache the parsed dataset between runs (default: %(default)s).')
+
+    parser.add_argument('--no-dataset-cache', dest = 'no_dataset_cache',
+        action = 'store_true', default = False,
+        help = 'If true, always parse the dataset and do not read or write the cache (default: %(default)s).')
+
+    parser.add_argument('--dataset-cache-key', dest = 'dataset_cache_key',
+        action = 'store', type = str, default = DATASET_CACHE_KEY_MTIME,
+        choices = DATASET_CACHE_KEY_TYPES,
+        help = 'How to detect changes in the dataset files: by size/modification time or by full content hash (default: %(default)s).')
+
+    parser.add_argument('--stream', dest = 'stream',
+        action = 'store_true', default = False,
+        help = 'If true, only keep users, courses, and assignments in memory and stream groupsets and submissions from the dataset cache.'
+            + ' The dataset is still fully parsed when the cache is missing or stale (default: %(default)s).')
+
+    parser.add_argument('--stream-chunk-size', dest = 'stream_chunk_size',
+        action = 'store', type = int, default = DEFAULT_STREAM_CHUNK_SIZE,
+        help = 'The number of submissions to load at a time (default: %(default)s).')
+
+    parser.add_argument('--max-concurrency', dest = 'max_concurrency',
+        action = 'store', type = int, default = 1,
+        help = 'The maximum number of concurrent requests when loading submissions and group memberships.'
+            + ' The actual number adapts to Canvas\'s rate limits and latency (default: %(default)s).')
+
+    parser.add_argument('--max-attempts', dest = 'max_attempts',
+        action = 'store', type = int, default = REQUEST_MAX_ATTEMPTS,
+        help = 'The maximum number of attempts for a request that fails transiently (default: %(default)s).')
+
+    parser.add_argument('--plan-out', dest = 'plan_out',
+        action = 'store', type = str, default = None,
+        help = 'If provided, do not load any data and instead write the plan for loading the dataset (all HTTP requests and SQL statements, in order) to this path.')
+
+    parser.add_argument('--plan-in', dest = 'plan_in',
+        action = 'store', type = str, default = None,
+        help = 'If provided, load data by executing the plan at this path (see --plan-out) instead of reading the dataset.')
+
+    parser.add_argument('--bulk-groups', dest = 'bulk_groups',
+        action = 'store_true', default = False,
+        help = 'If true, create each groupset\'s groups and memberships with a single CSV import.'
+            + ' Group names must be unique within each groupset.'
+            + ' The import\'s own records (progress, attachment) are removed afterwards so that later IDs are unchanged (default: %(default)s).')
+
+    return parser
 
-if __name__ == '__main__':
+if (__name__ == '__main__'):
     sys.exit(main())
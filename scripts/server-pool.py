@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+
+"""
+Manage a pool of warm Canvas servers that can be reused across test data runs (see generate-test-data.py and verify-test-data.py).
+Instead of booting a fresh server for every run, a running server is reset to its loaded baseline (via a database restore).
+"""
+
+# A pooled server runs on a private backend port.
+# The public port is only open (forwarded to the backend) while the instance is held and at its baseline,
+# so anything that polls the public port for readiness never sees a server that is booting, being snapshotted, or being reset.
+
+import argparse
+import fcntl
+import http
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_POOL_DIR: str = os.path.join(tempfile.gettempdir(), 'lms-docker-canvas-testdata-pool')
+DEFAULT_NAME: str = 'canvas-pool'
+DEFAULT_IMAGE_NAME: str = 'ghcr.io/edulinq/lms-docker-canvas-testdata'
+DEFAULT_PORT: int = 3000
+
+# Unless given, the backend port is the public port plus this offset.
+BACKEND_PORT_OFFSET: int = 10000
+FORWARD_BUFFER_SIZE: int = 64 * 1024
+
+DB_NAME: str = 'canvas_development'
+BASELINE_DB_NAME: str = 'canvas_baseline'
+
+# Commands are formatted with: {name}, {image}, {port}, {backend_port}.
+# The start command is run detached (in its own session) and may run in the foreground.
+# It should serve on the backend port (the public port is forwarded to it when the instance is ready).
+DEFAULT_START_COMMAND: str = "docker run --rm -p 127.0.0.1:{backend_port}:3000 --name '{name}' '{image}'"
+DEFAULT_STOP_COMMAND: str = "docker kill '{name}'"
+
+# Snapshot the freshly loaded database as a template database, and reset by re-creating the database from that template.
+# Connections are blocked and terminated first (Canvas will reconnect).
+_DISCONNECT_SQL: list = [
+    f"ALTER DATABASE {DB_NAME} ALLOW_CONNECTIONS false",
+    f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{DB_NAME}' AND pid <> pg_backend_pid()",
+]
+_RECONNECT_SQL: list = [
+    f"ALTER DATABASE {DB_NAME} ALLOW_CONNECTIONS true",
+]
+DEFAULT_SNAPSHOT_COMMAND: str = "docker exec '{name}' psql -d postgres " + ' '.join([f'-c "{sql}"' for sql in (
+    _DISCONNECT_SQL
+    + [f"DROP DATABASE IF EXISTS {BASELINE_DB_NAME}", f"CREATE DATABASE {BASELINE_DB_NAME} TEMPLATE {DB_NAME}"]
+    + _RECONNECT_SQL
+)])
+DEFAULT_RESET_COMMAND: str = "docker exec '{name}' psql -d postgres " + ' '.join([f'-c "{sql}"' for sql in (
+    _DISCONNECT_SQL
+    + [f"DROP DATABASE IF EXISTS {DB_NAME}", f"CREATE DATABASE {DB_NAME} TEMPLATE {BASELINE_DB_NAME}"]
+)])
+
+DEFAULT_HEALTH_URL: str = 'http://127.0.0.1:{backend_port}'
+HEALTH_TIMEOUT_SECS: float = 5.0
+
+# A cold start has to wait for Canvas to boot, a reset only has to wait for it to reconnect.
+START_WAIT_ATTEMPTS: int = 60
+RESET_WAIT_ATTEMPTS: int = 20
+WAIT_TIME_SECS: float = 5.0
+
+# While in use, an instance that fails this many health checks in a row is evicted.
+HOLD_CHECK_TIME_SECS: float = 10.0
+HOLD_MAX_FAILURES: int = 3
+
+class PoolError(Exception):
+    pass
+
+class _Released(Exception):
+    pass
+
+# Get a healthy instance at its loaded baseline, open the public port, and hold it until released
+# (or until it becomes unhealthy).
+# After being released, the instance is reset to its baseline (with the public port closed) for the next run.
+def acquire(options):
+    def _handle_signal(signum, frame):
+        raise _Released()
+
+    # A release may come at any point (e.g., during a cold start).
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+    lock = None
+    try:
+        lock = _lock(options)
+
+        # Mark this process as the holder before doing anything slow, so it can always be released.
+        _write_holder(options)
+
+        state = _get_baseline_instance(options)
+        state['clean'] = False
+        write_state(options, state)
+
+        try:
+            _hold(options)
+        except _Released:
+            pass
+
+        print(f"Pool instance '{options['name']}' was released, resetting it for the next run.", flush = True)
+        if (not _prepare_baseline(options, state)):
+            evict(options, state)
+    except _Released:
+        # Released before the instance was ready (or while resetting it, which the next run will redo).
+        print(f"Pool instance '{options['name']}' was released.", flush = True)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        if (lock is not None):
+            _remove_holder(options)
+            lock.close()
+
+    return 0
+
+# Release a held instance (leaving it running for the next run).
+def release(options):
+    holder_pid = _read_holder(options)
+    if (holder_pid is None):
+        print(f"Pool instance '{options['name']}' is not held.")
+        return 0
+
+    try:
+        os.kill(holder_pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+    return 0
+
+# Stop and remove the instance.
+def stop(options):
+    release(options)
+
+    # Wait for any holder to let go.
+    lock = _lock(options)
+    try:
+        state = read_state(options)
+        if (state is None):
+            print(f"Pool instance '{options['name']}' is not running.")
+            return 0
+
+        evict(options, state)
+    finally:
+        lock.close()
+
+    return 0
+
+def status(options):
+    state = read_state(options)
+    if (state is None):
+        print(f"Pool instance '{options['name']}' is not running.")
+        return 0
+
+    state['healthy'] = check_health(options)
+    state['holder_pid'] = _read_holder(options)
+    print(json.dumps(state, indent = 4))
+    return 0
+
+# Stop an instance and forget about it.
+def evict(options, state):
+    print(f"Evicting pool instance '{options['name']}'.", flush = True)
+
+    if (options['stop_command']):
+        _run_command(options, 'stop_command')
+    elif (state.get('pid', None) is not None):
+        # Without a stop command, stop the process group of the start command.
+        try:
+            os.killpg(state['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    _remove_state(options)
+
+def check_health(options):
+    url = options['health_url'].format(**options)
+
+    try:
+        with urllib.request.urlopen(url, timeout = HEALTH_TIMEOUT_SECS) as response:
+            return (response.status == http.HTTPStatus.OK)
+    except (urllib.error.URLError, OSError):
+        return False
+
+def wait_for_health(options, attempts):
+    for _ in range(attempts):
+        if (check_health(options)):
+            return True
+
+        time.sleep(WAIT_TIME_SECS)
+
+    return False
+
+def read_state(options):
+    path = _get_path(options, 'json')
+    if (not os.path.isfile(path)):
+        return None
+
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def write_state(options, state):
+    path = _get_path(options, 'json')
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(state, file, indent = 4)
+
+    os.replace(temp_path, path)
+
+# Get a running instance that is at its baseline, reusing a warm one when possible.
+def _get_baseline_instance(options):
+    state = read_state(options)
+    if (state is not None):
+        if (_is_reusable(options, state) and _prepare_baseline(options, state)):
+            state['reuses'] = state.get('reuses', 0) + 1
+            return state
+
+        evict(options, state)
+
+    state = _cold_start(options)
+    if (not _prepare_baseline(options, state)):
+        evict(options, state)
+        raise PoolError(f"Pool instance '{options['name']}' could not be brought to its baseline.")
+
+    return state
+
+def _is_reusable(options, state):
+    for key in ['image', 'port', 'backend_port']:
+        if (state.get(key, None) != options[key]):
+            print(f"Pool instance '{options['name']}' has a different {key} ('{state.get(key, None)}').", flush = True)
+            return False
+
+    return True
+
+# Bring a running instance to its baseline: snapshot a fresh instance, or reset a used one.
+# Returns False if the instance is not usable.
+def _prepare_baseline(options, state):
+    attempts = RESET_WAIT_ATTEMPTS
+    if (not state.get('snapshotted', False)):
+        # A fresh instance may still be booting.
+        attempts = START_WAIT_ATTEMPTS
+
+    if (not wait_for_health(options, attempts)):
+        print(f"Pool instance '{options['name']}' is unhealthy.", flush = True)
+        return False
+
+    if (not state.get('snapshotted', False)):
+        print(f"Snapshotting the baseline of pool instance '{options['name']}'.", flush = True)
+        if (not _run_command(options, 'snapshot_command')):
+            return False
+
+        state['snapshotted'] = True
+    elif (not state.get('clean', False)):
+        print(f"Resetting pool instance '{options['name']}'.", flush = True)
+        if (not _run_command(options, 'reset_command')):
+            return False
+    else:
+        return True
+
+    if (not wait_for_health(options, RESET_WAIT_ATTEMPTS)):
+        print(f"Pool instance '{options['name']}' did not recover after being brought to its baseline.", flush = True)
+        return False
+
+    state['clean'] = True
+    write_state(options, state)
+    return True
+
+# Start a new instance (without waiting for it).
+# Until it is snapshotted, a fresh instance is at its baseline (nothing can reach it through the public port).
+def _cold_start(options):
+    print(f"Starting pool instance '{options['name']}'.", flush = True)
+
+    command = options['start_command'].format(**options)
+    output = open(_get_path(options, 'log'), 'ab')
+
+    # Start in a new session so the server outlives this process.
+    process = subprocess.Popen(command, shell = True, stdout = output, stderr = subprocess.STDOUT, start_new_session = True)
+    output.close()
+
+    state = {
+        'name': options['name'],
+        'image': options['image'],
+        'port': options['port'],
+        'backend_port': options['backend_port'],
+        'pid': process.pid,
+        'started': time.time(),
+        'reuses': 0,
+        'snapshotted': False,
+        'clean': True,
+    }
+    write_state(options, state)
+
+    return state
+
+# Forward the public port to the instance until released (_Released is raised) or until it becomes unhealthy.
+def _hold(options):
+    forwarder = _Forwarder(options['port'], options['backend_port'])
+    print(f"Pool instance '{options['name']}' is ready.", flush = True)
+
+    try:
+        _watch_health(options)
+    finally:
+        forwarder.close()
+
+def _watch_health(options):
+    failures = 0
+    while (True):
+        time.sleep(HOLD_CHECK_TIME_SECS)
+
+        if (check_health(options)):
+            failures = 0
+            continue
+
+        failures += 1
+        if (failures >= HOLD_MAX_FAILURES):
+            state = read_state(options)
+            if (state is not None):
+                evict(options, state)
+
+            raise PoolError(f"Pool instance '{options['name']}' became unhealthy while in use.")
+
+# Forwards TCP connections from a public port to a backend port (on this host).
+class _Forwarder:
+    def __init__(self, port, backend_port):
+        self._backend_port = backend_port
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+
+        try:
+            self._server = socket.create_server(('', port))
+        except OSError as ex:
+            raise PoolError(f"Unable to listen on port {port}: '{ex}'.") from ex
+
+        threading.Thread(target = self._accept, daemon = True).start()
+
+    def close(self):
+        # Shut down first to wake up (and stop) the accepting thread, otherwise the port stays open.
+        _shutdown(self._server)
+        self._server.close()
+
+        with self._connections_lock:
+            for connection in self._connections:
+                _shutdown(connection)
+
+            self._connections.clear()
+
+    def _accept(self):
+        while (True):
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+
+            try:
+                backend = socket.create_connection(('127.0.0.1', self._backend_port))
+            except OSError:
+                client.close()
+                continue
+
+            with self._connections_lock:
+                self._connections.update([client, backend])
+
+            threading.Thread(target = self._forward, args = (client, backend), daemon = True).start()
+
+    def _forward(self, client, backend):
+        response_thread = threading.Thread(target = _pipe, args = (backend, client), daemon = True)
+        response_thread.start()
+
+        _pipe(client, backend)
+        response_thread.join()
+
+        with self._connections_lock:
+            self._connections.difference_update([client, backend])
+
+        client.close()
+        backend.close()
+
+# Copy data from one socket to another until the source is done.
+def _pipe(source, destination):
+    try:
+        while (True):
+            data = source.recv(FORWARD_BUFFER_SIZE)
+            if (len(data) == 0):
+                destination.shutdown(socket.SHUT_WR)
+                return
+
+            destination.sendall(data)
+    except OSError:
+        _shutdown(source)
+        _shutdown(destination)
+
+# Shut down a socket (which also wakes up any thread blocked on it).
+def _shutdown(connection):
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# The holder (the acquire process) is tracked separately from the instance's state,
+# since there is a holder before there is an instance (e.g., during a cold start).
+def _write_holder(options):
+    with open(_get_path(options, 'holder'), 'w') as file:
+        file.write(str(os.getpid()))
+
+def _read_holder(options):
+    path = _get_path(options, 'holder')
+    if (not os.path.isfile(path)):
+        return None
+
+    with open(path, 'r') as file:
+        text = file.read().strip()
+
+    if (text == ''):
+        return None
+
+    return int(text)
+
+def _remove_holder(options):
+    path = _get_path(options, 'holder')
+    if (os.path.exists(path)):
+        os.remove(path)
+
+# Take the pool lock for this instance (waiting for any other holder).
+def _lock(options):
+    lock = open(_get_path(options, 'lock'), 'w')
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"Waiting for pool instance '{options['name']}' to be released.", flush = True)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+    return lock
+
+# Run one of the configured commands, returns True on success.
+def _run_command(options, key):
+    command = options[key].format(**options)
+    result = subprocess.run(command, shell = True)
+
+    if (result.returncode != 0):
+        print(f"Pool command failed ({result.returncode}): '{command}'.", flush = True)
+        return False
+
+    return True
+
+def _remove_state(options):
+    path = _get_path(options, 'json')
+    if (os.path.exists(path)):
+        os.remove(path)
+
+def _get_path(options, extension):
+    os.makedirs(options['pool_dir'], exist_ok = True)
+    return os.path.join(options['pool_dir'], f"{options['name']}.{extension}")
+
+ACTIONS: dict = {
+    'acquire': acquire,
+    'release': release,
+    'stop': stop,
+    'status': status,
+}
+
+def run_cli(args):
+    backend_port = args.backend_port
+    if (backend_port is None):
+        backend_port = args.port + BACKEND_PORT_OFFSET
+
+    options = {
+        'name': args.name,
+        'image': args.image_name,
+        'port': args.port,
+        'backend_port': backend_port,
+        'pool_dir': args.pool_dir,
+        'start_command': args.start_command,
+        'stop_command': args.stop_command,
+        'snapshot_command': args.snapshot_command,
+        'reset_command': args.reset_command,
+        'health_url': args.health_url,
+    }
+
+    try:
+        return ACTIONS[args.action](options)
+    except PoolError as ex:
+        print(f"ERROR: {ex}", file = sys.stderr)
+        return 1
+
+def main():
+    return run_cli(_get_parser().parse_args())
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+
+    parser.add_argument('action', metavar = 'ACTION',
+        action = 'store', type = str, choices = sorted(ACTIONS.keys()),
+        help = 'What to do: acquire (and hold) a warm instance, release a held instance, stop an instance, or show its status.')
+
+    parser.add_argument('--name', dest = 'name',
+        action = 'store', type = str, default = DEFAULT_NAME,
+        help = 'The name of the pool instance (also used as the container name) (default: %(default)s).')
+
+    parser.add_argument('--image-name', dest = 'image_name',
+        action = 'store', type = str, default = DEFAULT_IMAGE_NAME,
+        help = 'The name of the image to run (default: %(default)s).')
+
+    parser.add_argument('--port', dest = 'port',
+        action = 'store', type = int, default = DEFAULT_PORT,
+        help = 'The port the server is available on (default: %(default)s).')
+
+    parser.add_argument('--backend-port', dest = 'backend_port',
+        action = 'store', type = int, default = None,
+        help = 'The private port the pooled server itself listens on (default: the port plus %s).' % (BACKEND_PORT_OFFSET))
+
+    parser.add_argument('--pool-dir', dest = 'pool_dir',
+        action = 'store', type = str, default = DEFAULT_POOL_DIR,
+        help = 'Where pool state, locks, and server output are kept (default: %(default)s).')
+
+    parser.add_argument('--start-command', dest = 'start_command',
+        action = 'store', type = str, default = DEFAULT_START_COMMAND,
+        help = 'The command to cold start a server (default: %(default)s).')
+
+    parser.add_argument('--stop-command', dest = 'stop_command',
+        action = 'store', type = str, default = DEFAULT_STOP_COMMAND,
+        help = 'The command to stop a server. If empty, the start command\'s processes will be terminated (default: %(default)s).')
+
+    parser.add_argument('--snapshot-command', dest = 'snapshot_command',
+        action = 'store', type = str, default = DEFAULT_SNAPSHOT_COMMAND,
+        help = 'The command to save the baseline state of a freshly started server (default: %(default)s).')
+
+    parser.add_argument('--reset-command', dest = 'reset_command',
+        action = 'store', type = str, default = DEFAULT_RESET_COMMAND,
+        help = 'The command to restore a warm server to its baseline state (default: %(default)s).')
+
+    parser.add_argument('--health-url', dest = 'health_url',
+        action = 'store', type = str, default = DEFAULT_HEALTH_URL,
+        help = 'The URL that responds with a 200 when the server is healthy (default: %(default)s).')
+
+    return parser
+
+if (__name__ == '__main__'):
+    sys.exit(main())